@@ -29,6 +29,14 @@ color_cycle = streamlit_template.layout.colorway
 plot_font_size = st.get_option("theme.baseFontSize")
 n_maxruns = 128
 
+# Line plots with more points than line_plot_webgl_points in total are drawn with WebGL, and each run is
+# downsampled to line_plot_max_points, about the width in pixels of a wide plot.
+line_plot_webgl_points = 10_000
+line_plot_max_points = 1_000
+
+# Animated plots have at most animate_max_frames frames, each frame holds the traces of all runs at one time.
+animate_max_frames = 200
+
 
 # Define all callback functions.
 def process_selected_run():
@@ -42,6 +50,7 @@ def process_selected_run():
         del(ss.settings_general_startdate)
         del(ss.settings_general_dt)
         del(ss.settings_general_dt_output)
+        del(ss.settings_general_integrator)
 
         del(ss.settings_mixedlayer_h)
         del(ss.settings_mixedlayer_beta)
@@ -59,6 +68,24 @@ def process_selected_run():
 
         del(ss.settings_fire_atmosphere_dtheta_plume)
         del(ss.settings_fire_atmosphere_dq_plume)
+        del(ss.settings_fire_solver_grid)
+        del(ss.settings_fire_solver_dz)
+
+        for key in plume_closure_settings:
+            del(ss[f"settings_fire_closure_{key}"])
+
+    clear_fork_form()
+
+
+def clear_fork_form():
+    # if the first item of the form exists, all items must exist.
+    if "fork_name_input" in ss:
+        del(ss.fork_name_input)
+        del(ss.fork_time)
+        del(ss.fork_wtheta)
+        del(ss.fork_wq)
+        del(ss.fork_beta)
+        del(ss.fork_div)
 
 
 def process_clone_run():
@@ -76,6 +103,46 @@ def process_clone_run():
     ss.all_runs_key = cloned_run
 
 
+def process_fork_run():
+    ss.main_mode = MainMode.FORK
+
+
+def process_fork_save():
+    fork_name = ss.fork_name_input.strip()
+    if fork_name in ss.all_runs:
+        st.warning(f"Run name {fork_name} already exists, aborting fork")
+        return
+
+    if len(ss.all_runs) >= n_maxruns:
+        st.warning(f"Maximum number of {n_maxruns} runs reached, aborting fork")
+        return
+
+    changes = {}
+    changes["wtheta"] = ss.fork_wtheta
+    changes["wq"] = ss.fork_wq * 1e-3
+    changes["beta"] = ss.fork_beta
+    changes["div"] = ss.fork_div
+
+    color_index = ss.available_colors.pop(0)
+    try:
+        ss.all_runs[fork_name] = ss.all_runs[ss.all_runs_key].fork(ss.fork_time * 3600, changes, color_index)
+    except ArithmeticError as error:
+        st.warning(f"Fork {fork_name} cannot be integrated with these settings, aborting fork ({error})")
+        ss.available_colors.append(color_index)
+        ss.available_colors.sort()
+        return
+
+    ss.all_runs_key = fork_name
+
+    clear_fork_form()
+    ss.main_mode = MainMode.PLOT
+
+
+def process_fork_cancel():
+    clear_fork_form()
+    ss.main_mode = MainMode.PLOT
+
+
 def process_edit_run():
     ss.main_mode = MainMode.EDIT
 
@@ -144,14 +211,14 @@ def process_edit_save():
             # Overwrite the previous key now the info is no longer needed.
             ss.all_runs_key = ss.run_name_input
 
-    color = ss.all_runs[ss.all_runs_key].color_index
-    del(ss.all_runs[ss.all_runs_key])
+    run = ss.all_runs[ss.all_runs_key]
     settings = {}
     settings["runtime"] = ss.settings_general_runtime
     settings["starttime"] = ss.settings_general_starttime
     settings["startdate"] = ss.settings_general_startdate
     settings["dt"] = ss.settings_general_dt
     settings["dt_output"] = ss.settings_general_dt_output
+    settings["integrator"] = ss.settings_general_integrator
 
     settings["h"] = ss.settings_mixedlayer_h
     settings["beta"] = ss.settings_mixedlayer_beta
@@ -170,8 +237,27 @@ def process_edit_save():
 
     settings["dtheta_plume"] = ss.settings_fire_atmosphere_dtheta_plume
     settings["dq_plume"] = ss.settings_fire_atmosphere_dq_plume * 1e-3
+    settings["plume_grid"] = ss.settings_fire_solver_grid
+    settings["plume_dz"] = ss.settings_fire_solver_dz
+    for key in plume_closure_settings:
+        settings[key] = ss[f"settings_fire_closure_{key}"]
+
+    # Forked runs keep their parent.
+    for key in ["fork_time", "fork_parent"]:
+        if key in run.settings:
+            settings[key] = run.settings[key]
+
+    # A longer runtime with otherwise identical settings continues the run from its final state.
+    # Settings that cannot be integrated, e.g. without an inversion jump, keep the old run and the edit form open.
+    try:
+        if run.can_resume(settings):
+            run.resume(settings["runtime"])
+        else:
+            ss.all_runs[ss.all_runs_key] = MixedLayerModel(settings, run.color_index)
+    except ArithmeticError as error:
+        st.warning(f"Run {ss.all_runs_key} cannot be integrated with these settings, keeping the old run ({error})")
+        return
 
-    ss.all_runs[ss.all_runs_key] = MixedLayerModel(settings, color)
     ss.main_mode = MainMode.PLOT
 
 
@@ -220,6 +306,871 @@ def process_sounding_close():
     ss.main_mode = MainMode.PLOT
 
 
+# Figure builders of the plot types, they return the figure and a dict with the toasts, parcel table rows and warnings
+# to show with it. The figures are cached in figure_cache, so the builders must not call Streamlit themselves.
+def build_line_figure(i, plot):
+    fig = go.Figure()
+
+    # Collect the series of all runs first, the rendering depends on the total number of points.
+    series = []
+    for run_name in plot.selected_runs:
+        run = ss.all_runs[run_name]
+
+        # The plume and parcel diagnostics are computed for all output times at once, and memoized on the run.
+        fire_label = ss.get(f"plot_{i}_fire") or "1 x"
+        if plot.yaxis_key in plume_diagnostic_variables:
+            y_plot = run.get_plume_diagnostics(float(fire_label.split()[0]))[plot.yaxis_key]
+        elif plot.yaxis_key in parcel_diagnostic_variables:
+            parcel = ss.get(f"plot_{i}_parcel") or "mixed-layer"
+            y_plot = run.get_parcel_diagnostics(float(fire_label.split()[0]))[parcel][plot.yaxis_key.split()[1]]
+        else:
+            y_plot = run.output[plot.yaxis_key]
+
+        series.append((run_name, run, run.output[plot.xaxis_key], y_plot))
+
+    # Many points are drawn with WebGL, and downsampled along the numeric time, which orders the points of both x-axes.
+    high_volume = sum(len(y_plot) for _, _, _, y_plot in series) > line_plot_webgl_points
+    scatter = go.Scattergl if high_volume else go.Scatter
+
+    if high_volume:
+        indices = calc_lttb_indices(
+            [ run.output.time for _, run, _, _ in series ],
+            [ np.asarray(y_plot, dtype=np.float64) for _, _, _, y_plot in series ],
+            line_plot_max_points)
+        series = [ (run_name, run, x_plot[idx], y_plot[idx]) for (run_name, run, x_plot, y_plot), idx in zip(series, indices) ]
+
+    if ss.get(f"plot_{i}_merge"):
+        # Runs with the same color are one trace, separated by gaps, the name of the run is in the hover info.
+        groups = {}
+        for run_name, run, x_plot, y_plot in series:
+            groups.setdefault(run.color_index % len(color_cycle), []).append((run_name, x_plot, y_plot))
+
+        for color_index, group in groups.items():
+            run_names = [ run_name for run_name, _, _ in group ]
+            fig.add_trace(
+                scatter(
+                    x=np.concatenate([ np.append(x_plot, np.array([np.nan]).astype(x_plot.dtype)) for _, x_plot, _ in group ]),
+                    y=np.concatenate([ np.append(np.asarray(y_plot, dtype=np.float64), np.nan) for _, _, y_plot in group ]),
+                    customdata=np.concatenate([ np.full(len(x_plot) + 1, run_name, dtype=object) for run_name, x_plot, _ in group ]),
+                    hovertemplate=f"%{{customdata}}<br>{plot.xaxis_key}: %{{x}}<br>{plot.yaxis_key}: %{{y}}<extra></extra>",
+                    mode="lines+markers",
+                    name=", ".join(run_names) if len(run_names) <= 3 else f"{run_names[0]} and {len(run_names) - 1} more",
+                    line=dict(color=color_cycle[color_index])
+                )
+            )
+
+    else:
+        for run_name, run, x_plot, y_plot in series:
+            fig.add_trace(
+                scatter(
+                    x=x_plot,
+                    y=y_plot,
+                    mode="lines+markers", name=run_name,
+                    line=dict(color=color_cycle[run.color_index % len(color_cycle)])
+                )
+            )
+
+    fig.update_traces(showlegend=True)
+    fig.update_layout(
+        margin={"t": 50, "l": 0, "b": 0, "r": 0},
+        xaxis_title=plot.xaxis_key,
+        yaxis_title=plot.yaxis_key,
+        xaxis_title_font_size=plot_font_size,
+        xaxis_tickfont_size=plot_font_size,
+        yaxis_title_font_size=plot_font_size,
+        yaxis_tickfont_size=plot_font_size,
+        legend_font_size=plot_font_size,
+    )
+
+    return fig, {}
+
+
+def build_profile_figure(i, plot):
+    fig = go.Figure()
+    toasts = []
+    animate = ss.get(f"plot_{i}_animate", False) and len(plot.selected_runs) > 0
+
+    # Get the plot ranges
+    h_max = -1e9
+
+    for run_name in plot.selected_runs:
+        run = ss.all_runs[run_name]
+        h_max = max(h_max, np.nanmax(run.output.h))
+
+    h_max *= 1.35
+
+    # Plot the reference state.
+    time_plot = plot.time_plot[0] * 3600
+    for run_name in plot.selected_runs:
+        run = ss.all_runs[run_name]
+        if time_plot <= run.runtime:
+            fig.add_trace(calc_profile_trace(run, run_name, *calc_profile_lines(run, plot.xaxis_key, time_plot, h_max), reference=True))
+
+    # Plot the actual state if available.
+    n_static = len(fig.data)
+    fig.add_traces(calc_profile_frame(plot, plot.time_plot[1] * 3600, h_max, animate))
+
+    for sounding_name in ss[f"plot_{i}_soundings"]:
+        sounding_df = ss.all_soundings[sounding_name]
+
+        if plot.xaxis_key not in sounding_df.columns:
+            toasts.append(f"Requested variable \"{plot.xaxis_key}\" is not in sounding \"{sounding_name}\"")
+
+        else:
+            fig.add_trace(
+                go.Scatter(
+                    x=sounding_df[plot.xaxis_key],
+                    y=sounding_df["z"],
+                    mode="markers",
+                    showlegend=True,
+                    name=sounding_name,
+                    marker=dict(
+                        color="black",
+                        symbol="cross",
+                        size=3,
+                        )
+                )
+            )
+
+    fig.update_layout(
+        margin={"t": 50, "l": 0, "b": 0, "r": 0},
+        xaxis_title=plot.xaxis_key,
+        yaxis_title="z",
+        xaxis_title_font_size=plot_font_size,
+        xaxis_tickfont_size=plot_font_size,
+        yaxis_title_font_size=plot_font_size,
+        yaxis_tickfont_size=plot_font_size,
+        legend_font_size=plot_font_size,
+    )
+
+    if animate:
+        frame_times = calc_frame_times(plot)
+        frames = [ calc_profile_frame(plot, time_plot, h_max, animate) for time_plot in frame_times ]
+        add_time_frames(fig, frame_times, frames, n_static, plot.time_plot[1] * 3600, fix_ranges=True)
+
+    return fig, {"toasts": toasts}
+
+
+def build_plume_figure(i, plot):
+    fig = go.Figure()
+    toasts = []
+    plot_warnings = []
+    animate = ss.get(f"plot_{i}_animate", False) and len(plot.selected_runs) > 0
+    fire_labels = sorted(ss[f"plot_{i}_fire"])
+
+    # Get the plot ranges
+    h_max = -1e9
+
+    for run_name in plot.selected_runs:
+        run = ss.all_runs[run_name]
+        h_max = max(h_max, np.nanmax(run.output.h))
+
+    h_max *= 2.0
+
+    # Plot the reference state, if they are the same, double plotting is not necessary.
+    if plot.time_plot[0] != plot.time_plot[1]:
+        time_plot = plot.time_plot[0] * 3600
+        for run_name in plot.selected_runs:
+            run = ss.all_runs[run_name]
+            if time_plot <= run.runtime:
+                fig.add_trace(calc_profile_trace(run, run_name, *calc_profile_lines(run, plot.xaxis_key, time_plot, h_max), reference=True))
+
+                # Integrate all selected plumes in one pass.
+                plumes = run.launch_entraining_plumes(time_plot, [ float(fire_label.split()[0]) for fire_label in fire_labels ])
+                for fire_label, plume in zip(fire_labels, plumes):
+                    fig.add_trace(calc_plume_trace(fire_label, getattr(plume, plot.xaxis_key), plume.z, plume.type, reference=True))
+
+    # Plot the actual state if available.
+    n_static = len(fig.data)
+    fig.add_traces(calc_plume_frame(plot, fire_labels, plot.time_plot[1] * 3600, h_max, animate))
+
+    # Warnings of the environment columns the plumes went through, at the plotted times.
+    for run_name in plot.selected_runs:
+        run = ss.all_runs[run_name]
+        for time_plot in sorted(set(plot.time_plot)):
+            if time_plot * 3600 <= run.runtime:
+                plot_warnings += [ f"{run_name} at {time_plot:.2f} h: {warning}" for warning in run.get_environment(time_plot * 3600).get_warnings() ]
+
+    for sounding_name in ss[f"plot_{i}_soundings"]:
+        sounding_df = ss.all_soundings[sounding_name]
+
+        if plot.xaxis_key not in sounding_df.columns:
+            toasts.append(f"Requested variable \"{plot.xaxis_key}\" is not in sounding \"{sounding_name}\"")
+
+        else:
+            fig.add_trace(
+                go.Scatter(
+                    x=sounding_df[plot.xaxis_key],
+                    y=sounding_df["z"],
+                    mode="markers",
+                    showlegend=True,
+                    name=sounding_name,
+                    marker=dict(
+                        color="black",
+                        symbol="cross",
+                        size=3,
+                        )
+                )
+            )
+
+    fig.update_layout(
+        margin={"t": 50, "l": 0, "b": 0, "r": 0},
+        xaxis_title=plot.xaxis_key,
+        yaxis_title="z",
+        xaxis_title_font_size=plot_font_size,
+        xaxis_tickfont_size=plot_font_size,
+        yaxis_title_font_size=plot_font_size,
+        yaxis_tickfont_size=plot_font_size,
+        legend_font_size=plot_font_size,
+    )
+
+    if animate:
+        frame_times = calc_frame_times(plot)
+        prefetch_frame_plumes(plot, fire_labels, frame_times)
+        frames = [ calc_plume_frame(plot, fire_labels, time_plot, h_max, animate) for time_plot in frame_times ]
+        add_time_frames(fig, frame_times, frames, n_static, plot.time_plot[1] * 3600, fix_ranges=True)
+
+    return fig, {"toasts": toasts, "warnings": plot_warnings}
+
+
+def build_skew_figure(i, plot):
+    fig = go.Figure()
+    plot_warnings = []
+    parcel_rows = []
+    animate = ss.get(f"plot_{i}_animate", False) and len(plot.selected_runs) > 0
+    fire_labels = sorted(ss[f"plot_{i}_fire"])
+
+    ## ADD BACKGROUND LINES
+    # The background is computed once per process, each family of lines is a single trace.
+    background_styles = {
+        "isotherms": dict(color='red', width=0.5, dash='solid'),
+        "dry adiabats": dict(color='green', width=0.6, dash='dash'),
+        "moist adiabats": dict(color='blue', width=0.6, dash='dot'),
+        "mixing-ratio lines": dict(color='purple', width=0.5, dash='dashdot'),
+    }
+    for name, (x, y) in get_skew_background().items():
+        fig.add_trace(go.Scatter(
+            x=x,
+            y=y,
+            mode='lines',
+            line=background_styles[name],
+            name=name,
+            showlegend=False,
+            hoverinfo="none",
+            connectgaps=False,
+        ))
+    ## FINISH BACKGROUND LINES
+
+
+    # Warnings and parcel diagnostics of the soundings.
+    time_plot = plot.time_plot * 3600
+    for run_name in plot.selected_runs:
+        run = ss.all_runs[run_name]
+
+        if time_plot <= run.runtime:
+            sounding = run.get_sounding(time_plot)
+            plot_warnings += [ f"{run_name}: {warning}" for warning in sounding.get_warnings() ]
+
+            # Parcel diagnostics, the fire-plume parcel for each selected fire multiplier.
+            for n_fire, fire_label in enumerate(fire_labels or ["1 x"]):
+                for parcel, diagnostics in run.calc_parcels(time_plot, float(fire_label.split()[0])).items():
+                    if parcel == "fire plume":
+                        if not fire_labels:
+                            continue
+                        parcel = f"🔥 {fire_label}"
+                    elif n_fire > 0:
+                        continue
+                    parcel_rows.append({
+                        "run": run_name,
+                        "parcel": parcel,
+                        "LCL (hPa)": diagnostics["p LCL"],
+                        "LFC (hPa)": diagnostics["p LFC"],
+                        "EL (hPa)": diagnostics["p EL"],
+                        "CAPE (J kg-1)": diagnostics["CAPE"],
+                        "CIN (J kg-1)": diagnostics["CIN"],
+                    })
+
+    # Plot the soundings and plumes.
+    n_static = len(fig.data)
+    fig.add_traces(calc_skew_frame(plot, fire_labels, time_plot, animate))
+
+    fig.update_layout(
+        margin={"t": 50, "l": 0, "b": 0, "r": 0},
+        xaxis_title="temperature (°C)",
+        yaxis_title="p (hPa)",
+        yaxis_type="log",
+        xaxis_range = [-40, 50],
+        yaxis_range = [np.log10(1040), np.log10(490)],
+        yaxis_autorange=False,
+        xaxis_title_font_size=plot_font_size,
+        xaxis_tickfont_size=plot_font_size,
+        yaxis_title_font_size=plot_font_size,
+        yaxis_tickfont_size=plot_font_size,
+        legend_font_size=plot_font_size,
+    )
+
+    if animate:
+        frame_times = calc_frame_times(plot)
+        prefetch_frame_plumes(plot, fire_labels, frame_times)
+        frames = [ calc_skew_frame(plot, fire_labels, time_plot, animate) for time_plot in frame_times ]
+        add_time_frames(fig, frame_times, frames, n_static, plot.time_plot * 3600)
+
+    return fig, {"parcel_rows": parcel_rows, "warnings": plot_warnings}
+
+
+# Fire multipliers of the plume and skew-T plots and their colors.
+fire_colors = {
+    "0.25 x": "#781c6d",
+    "0.5 x": "#bc3754",
+    "1 x": "#dd513a",
+    "2 x": "#f37819",
+    "4 x": "#fca50a",
+}
+
+
+# Mixed-layer profile of xaxis_key of run at time_plot (s) up to h_max, as x and z of the four points of the profile.
+def calc_profile_lines(run, xaxis_key, time_plot, h_max):
+    state = run.state_at(time_plot)
+
+    h = state["h"]
+
+    if xaxis_key == "theta":
+        theta = state["theta"]
+        dtheta = state["dtheta"]
+        gammatheta = run.gammatheta
+        x_plot = [theta, theta, theta + dtheta, theta + dtheta + gammatheta*(h_max-h)]
+
+    elif xaxis_key == "q":
+        q = state["q"]
+        dq = state["dq"]
+        gammaq = run.gammaq * 1e3
+        x_plot = [q, q, q + dq, q + dq + gammaq*(h_max-h)]
+
+    elif xaxis_key == "thetav":
+        theta = state["theta"]
+        dtheta = state["dtheta"]
+        gammatheta = run.gammatheta
+
+        # Convert back to kg/kg
+        q = state["q"] * 1e-3
+        dq = state["dq"] * 1e-3
+        gammaq = run.gammaq
+
+        x_plot = [
+            virtual_temperature(theta, q, 0.0),
+            virtual_temperature(theta, q, 0.0),
+            virtual_temperature(theta + dtheta, q + dq, 0.0),
+            virtual_temperature(theta + dtheta + gammatheta*(h_max-h), q + dq + gammaq*(h_max-h), 0.0)
+        ]
+
+    elif xaxis_key == "w":
+        x_plot = np.array([np.nan, np.nan, np.nan, np.nan])
+
+    z_plot = [0, h, h, h_max]
+
+    return x_plot, z_plot
+
+
+# Trace of the mixed-layer profile of a run, the reference state is dotted and not in the legend.
+def calc_profile_trace(run, run_name, x_plot, z_plot, reference=False):
+    color = color_cycle[run.color_index % len(color_cycle)]
+
+    return go.Scatter(
+        x=x_plot,
+        y=z_plot,
+        mode="lines+markers",
+        showlegend=not reference,
+        name=None if reference else run_name,
+        line=dict(color=color, dash="dot" if reference else "solid"),
+    )
+
+
+# Trace of a plume, with markers at every fifth saturated level and at the bottom and top. The reference state is dotted.
+def calc_plume_trace(fire_label, x_plot, y_plot, type_plume, reference=False):
+    marker_sizes = np.zeros(len(y_plot))
+    if len(marker_sizes) > 0:
+        marker_sizes[::5] = np.where(np.asarray(type_plume)[::5] > 0, 5, marker_sizes[::5])
+        marker_sizes[0], marker_sizes[-1] = 5, 5
+
+    return go.Scatter(
+        x=x_plot,
+        y=y_plot,
+        mode="lines+markers",
+        showlegend=not reference,
+        name=None if reference else f"🔥 {fire_label}",
+        line=dict(
+            color=fire_colors[fire_label],
+            dash="dot" if reference else "solid",
+            width=1.5,
+            ),
+        marker=dict(
+            color=fire_colors[fire_label],
+            size=marker_sizes,
+            )
+    )
+
+
+# Traces of the actual state of the selected runs of a profile plot at time_plot (s). Runs that do not reach
+# time_plot have no traces, or empty ones for an animated plot, which needs the same traces in every frame.
+def calc_profile_frame(plot, time_plot, h_max, animate=False):
+    traces = []
+    for run_name in plot.selected_runs:
+        run = ss.all_runs[run_name]
+        if time_plot <= run.runtime:
+            traces.append(calc_profile_trace(run, run_name, *calc_profile_lines(run, plot.xaxis_key, time_plot, h_max)))
+        elif animate:
+            traces.append(calc_profile_trace(run, run_name, [], []))
+
+    return traces
+
+
+# Traces of the actual state and the plumes of the selected runs of a plume plot at time_plot (s), see calc_profile_frame.
+def calc_plume_frame(plot, fire_labels, time_plot, h_max, animate=False):
+    traces = []
+    for run_name in plot.selected_runs:
+        run = ss.all_runs[run_name]
+        if time_plot <= run.runtime:
+            traces.append(calc_profile_trace(run, run_name, *calc_profile_lines(run, plot.xaxis_key, time_plot, h_max)))
+
+            # Integrate all selected plumes in one pass.
+            plumes = run.launch_entraining_plumes(time_plot, [ float(fire_label.split()[0]) for fire_label in fire_labels ])
+            for fire_label, plume in zip(fire_labels, plumes):
+                traces.append(calc_plume_trace(fire_label, getattr(plume, plot.xaxis_key), plume.z, plume.type))
+
+        elif animate:
+            traces.append(calc_profile_trace(run, run_name, [], []))
+            for fire_label in fire_labels:
+                traces.append(calc_plume_trace(fire_label, [], [], []))
+
+    return traces
+
+
+# Traces of the soundings and plumes of the selected runs of a skew-T plot at time_plot (s), see calc_profile_frame.
+def calc_skew_frame(plot, fire_labels, time_plot, animate=False):
+    traces = []
+    for run_name in plot.selected_runs:
+        run = ss.all_runs[run_name]
+        color = color_cycle[run.color_index % len(color_cycle)]
+
+        if time_plot <= run.runtime:
+            sounding_pressure, sounding_temp, sounding_dewpoint = calc_sounding_lines(run.get_sounding(time_plot))
+            plumes = run.launch_entraining_plumes(time_plot, [ float(fire_label.split()[0]) for fire_label in fire_labels ])
+        elif animate:
+            sounding_pressure, sounding_temp, sounding_dewpoint = [], [], []
+            plumes = [None for fire_label in fire_labels]
+        else:
+            continue
+
+        traces.append(
+            go.Scatter(
+                x=skew_transform(np.asarray(sounding_temp), np.asarray(sounding_pressure)),
+                y=sounding_pressure,
+                mode="lines",
+                line=dict(color=color),
+                name=f"{run_name} (T)",
+                hovertemplate='Temperature: %{customdata}°C<br>Pressure: %{y} hPa<extra></extra>',
+                customdata=sounding_temp
+            )
+        )
+
+        traces.append(
+            go.Scatter(
+                x=skew_transform(np.asarray(sounding_dewpoint), np.asarray(sounding_pressure)),
+                y=sounding_pressure,
+                mode='lines',
+                name=f"{run_name} (Td)",
+                line=dict(color=color, dash="dot"),
+                hovertemplate='Dewpoint: %{customdata}°C<br>Pressure: %{y} hPa<extra></extra>',
+                customdata=sounding_dewpoint
+        ))
+
+        for fire_label, plume in zip(fire_labels, plumes):
+            if plume is None:
+                traces.append(calc_plume_trace(fire_label, [], [], []))
+            else:
+                traces.append(calc_plume_trace(fire_label, skew_transform(plume.T, plume.p), plume.p, plume.type))
+
+    return traces
+
+
+# Times (s) of the frames of an animated plot. The state is interpolated in time, so the frames are at the
+# smallest output interval of the selected runs, and at least every step of the time slider, up to the runtimes.
+def calc_frame_times(plot):
+    runs = [ ss.all_runs[run_name] for run_name in plot.selected_runs ]
+    frame_dt = min([0.25 * 3600] + [ run.dt_output for run in runs ])
+    runtime = max([ run.runtime for run in runs ])
+
+    # Long runs with a short output interval use every n-th frame time, leaving room for the end times of the runs.
+    n_frames = max(animate_max_frames - len(runs), 1)
+    frame_dt *= max(1, int(np.ceil(runtime / frame_dt / n_frames)))
+
+    return np.unique(np.concatenate([ np.arange(0, runtime, frame_dt), [ run.runtime for run in runs ] ]))
+
+
+# Integrate the plumes of all frames of the selected runs of an animated plot, in one batch per run.
+def prefetch_frame_plumes(plot, fire_labels, frame_times):
+    for run_name in plot.selected_runs:
+        run = ss.all_runs[run_name]
+        run.launch_plume_batch([
+            (time_plot, float(fire_label.split()[0])) for time_plot in frame_times[frame_times <= run.runtime] for fire_label in fire_labels ])
+
+
+# Add the frames to fig, with a slider and play button to scrub the time in the browser. Each frame holds the
+# traces from index n_static onward at one of the frame_times (s), the slider starts at active_time (s).
+# With fix_ranges, the axis ranges cover all frames, so that the axes do not jump while scrubbing.
+def add_time_frames(fig, frame_times, frames, n_static, active_time, fix_ranges=False):
+    animated = list(range(n_static, n_static + len(frames[0])))
+    # The frames are named by index, the rounded times in the labels of the slider can coincide.
+    names = [ str(n) for n in range(len(frame_times)) ]
+    labels = [ f"{time_plot / 3600:.4g}" for time_plot in frame_times ]
+
+    fig.frames = [ go.Frame(data=frame, traces=animated, name=name) for frame, name in zip(frames, names) ]
+
+    if fix_ranges:
+        traces = list(fig.data) + [ trace for frame in frames for trace in frame ]
+        for axis in ["x", "y"]:
+            values = np.concatenate([ np.asarray(getattr(trace, axis), dtype=np.float64).ravel() for trace in traces ] + [ [np.nan] ])
+            if np.isfinite(values).any():
+                values_min, values_max = np.nanmin(values), np.nanmax(values)
+                margin = 0.05 * (values_max - values_min) if values_max > values_min else 1.0
+                fig.update_layout({ f"{axis}axis_range": [values_min - margin, values_max + margin] })
+
+    animation = dict(mode="immediate", frame=dict(duration=0, redraw=False), transition=dict(duration=0))
+    fig.update_layout(
+        sliders=[dict(
+            active=int(np.argmin(np.abs(frame_times - active_time))),
+            currentvalue=dict(prefix="time (h): ", font_size=plot_font_size),
+            pad=dict(t=40),
+            steps=[ dict(label=label, method="animate", args=[[name], animation]) for name, label in zip(names, labels) ],
+        )],
+        updatemenus=[dict(
+            type="buttons",
+            showactive=False,
+            direction="left",
+            x=0.0,
+            y=0.0,
+            xanchor="right",
+            yanchor="top",
+            pad=dict(t=40, r=10),
+            buttons=[
+                dict(label="▶", method="animate", args=[None, dict(animation, frame=dict(duration=150, redraw=False), fromcurrent=True)]),
+                dict(label="⏸", method="animate", args=[[None], animation]),
+            ],
+        )],
+    )
+
+
+# Key of plot i in figure_cache. The figure depends on the plot settings and widgets, the name, settings and color of
+# the selected runs, the selected soundings and the font size, a run that is edited gets a new settings_hash.
+def calc_figure_key(i, plot):
+    fire = ss.get(f"plot_{i}_fire")
+    return settings_hash({
+        "type": type(plot).__name__,
+        "plot": vars(plot),
+        "fire": sorted(fire) if isinstance(fire, list) else fire,
+        "parcel": ss.get(f"plot_{i}_parcel"),
+        "animate": ss.get(f"plot_{i}_animate"),
+        "merge": ss.get(f"plot_{i}_merge"),
+        "runs": [ (run_name, ss.all_runs[run_name].settings_hash, ss.all_runs[run_name].color_index) for run_name in plot.selected_runs ],
+        "soundings": [ (sounding_name, settings_hash(ss.all_soundings[sounding_name].to_dict("list"))) for sounding_name in ss.get(f"plot_{i}_soundings", []) ],
+        "font size": plot_font_size,
+    })
+
+
+# Sidebar controls of plot i, they update the plot object from the widget state.
+def show_plot_controls(i, plot):
+    if isinstance(plot, LinePlot):
+        if f"plot_{i}_runs" not in ss:
+            ss[f"plot_{i}_runs"] = list(ss.all_runs.keys())
+
+        # Update plot state BEFORE rendering selectboxes
+        if f"plot_{i}_xaxis" in ss:
+            plot.xaxis_key = ss[f"plot_{i}_xaxis"]
+            plot.xaxis_index = plot.xaxis_options.index(plot.xaxis_key)
+
+        if f"plot_{i}_yaxis" in ss:
+            plot.yaxis_key = ss[f"plot_{i}_yaxis"]
+            plot.yaxis_index = plot.yaxis_options.index(plot.yaxis_key)
+
+        plot.selected_runs = ss[f"plot_{i}_runs"]
+
+        with st.container(border=True):
+            col1, col2 = st.columns([2, 1])
+            col1.header(f":material/line_axis: Plot {i}")
+            col2.button(
+                    "",
+                    icon=":material/delete:",
+                    use_container_width=True,
+                    key=f"plot_{i}_delete",
+                    on_click=process_delete_plot,
+                    args=(i,)
+            )
+
+            x_axis, y_axis = st.columns(2)
+            x_axis.selectbox("X-axis", plot.xaxis_options, index=plot.xaxis_index, key=f"plot_{i}_xaxis")
+            y_axis.selectbox("Y-axis", plot.yaxis_options, index=plot.yaxis_index, key=f"plot_{i}_yaxis")
+
+            st.multiselect(
+                "Runs to plot",
+                options=list(ss.all_runs.keys()),
+                key=f"plot_{i}_runs",
+            )
+
+            st.toggle(
+                "Merge runs",
+                help="Draw the runs with the same color as one trace, which is faster with many runs",
+                key=f"plot_{i}_merge")
+
+            if plot.yaxis_key in parcel_diagnostic_variables:
+                if f"plot_{i}_parcel" not in ss:
+                    ss[f"plot_{i}_parcel"] = "mixed-layer"
+
+                st.pills(
+                    "Parcel",
+                    parcel_names,
+                    selection_mode="single",
+                    key=f"plot_{i}_parcel")
+
+            if (plot.yaxis_key in plume_diagnostic_variables) or (
+                    plot.yaxis_key in parcel_diagnostic_variables and ss[f"plot_{i}_parcel"] == "fire plume"):
+                if f"plot_{i}_fire" not in ss:
+                    ss[f"plot_{i}_fire"] = "1 x"
+
+                st.pills(
+                    "🔥 Fire multiplier",
+                    ["0.25 x", "0.5 x", "1 x", "2 x", "4 x"],
+                    selection_mode="single",
+                    key=f"plot_{i}_fire")
+
+    elif isinstance(plot, ProfilePlot):
+        if f"plot_{i}_runs" not in ss:
+            ss[f"plot_{i}_runs"] = list(ss.all_runs.keys())
+        if f"plot_{i}_soundings" not in ss:
+            ss[f"plot_{i}_soundings"] = []
+
+        # Update plot state BEFORE rendering selectboxes
+        if f"plot_{i}_xaxis" in ss:
+            plot.xaxis_key = ss[f"plot_{i}_xaxis"]
+            plot.xaxis_index = plot.xaxis_options.index(plot.xaxis_key)
+
+        if f"plot_{i}_time" in ss:
+            plot.time_plot = ss[f"plot_{i}_time"]
+
+        plot.selected_runs = ss[f"plot_{i}_runs"]
+
+        with st.container(border=True):
+            col1, col2 = st.columns([2, 1])
+            col1.header(f":material/expand: Plot {i}")
+            col2.button(
+                "",
+                icon=":material/delete:",
+                use_container_width=True,
+                key=f"plot_{i}_delete",
+                on_click=process_delete_plot,
+                args=(i,)
+            )
+
+            x_axis, time_slider = st.columns(2)
+            x_axis.selectbox("X-axis", plot.xaxis_options, index=plot.xaxis_index, key=f"plot_{i}_xaxis")
+
+            time_slider.slider("Time", 0.0, ss.time_max, plot.time_plot, 0.25, key=f"plot_{i}_time")
+
+            st.toggle(
+                "Animate",
+                help="Precompute all output times, to scrub the time in the plot without reruns",
+                key=f"plot_{i}_animate")
+
+            st.multiselect(
+                "Runs to plot",
+                options=list(ss.all_runs.keys()),
+                key=f"plot_{i}_runs",
+            )
+
+            st.multiselect(
+                "Soundings to plot",
+                options=list(ss.all_soundings.keys()),
+                key=f"plot_{i}_soundings",
+            )
+
+
+    elif isinstance(plot, PlumePlot):
+        if f"plot_{i}_runs" not in ss:
+            ss[f"plot_{i}_runs"] = [ss.all_runs_key]
+        if f"plot_{i}_soundings" not in ss:
+            ss[f"plot_{i}_soundings"] = []
+
+        # Update plot state BEFORE rendering selectboxes
+        if f"plot_{i}_xaxis" in ss:
+            plot.xaxis_key = ss[f"plot_{i}_xaxis"]
+            plot.xaxis_index = plot.xaxis_options.index(plot.xaxis_key)
+
+        if f"plot_{i}_time" in ss:
+            plot.time_plot = ss[f"plot_{i}_time"]
+
+        plot.selected_runs = ss[f"plot_{i}_runs"]
+
+        with st.container(border=True):
+            col1, col2 = st.columns([2, 1])
+            col1.header(f":material/local_fire_department: Plot {i}")
+            col2.button(
+                "",
+                icon=":material/delete:",
+                use_container_width=True,
+                key=f"plot_{i}_delete",
+                on_click=process_delete_plot,
+                args=(i,)
+            )
+
+            x_axis, time_slider = st.columns(2)
+            x_axis.selectbox("X-axis", plot.xaxis_options, index=plot.xaxis_index, key=f"plot_{i}_xaxis")
+
+            # Prevent the slider to select a value that does not exist.
+            if not ss[f"plot_{i}_runs"]:
+                time_max = 1.0
+                time_plot = (0.0, 1.0)
+            else:
+                time_max = ss.all_runs[ss[f"plot_{i}_runs"][0]].output.time[-1]
+                time_plot = (0.0 if plot.time_plot[0] > time_max else plot.time_plot[0], min(time_max, plot.time_plot[1]))
+
+            time_slider.slider("Time", 0.0, time_max, time_plot, 0.25, key=f"plot_{i}_time")
+
+            st.toggle(
+                "Animate",
+                help="Precompute all output times, to scrub the time in the plot without reruns",
+                key=f"plot_{i}_animate")
+
+            st.multiselect(
+                "Runs to plot",
+                options=list(ss.all_runs.keys()),
+                key=f"plot_{i}_runs",
+            )
+
+            if f"plot_{i}_fire" not in ss:
+                ss[f"plot_{i}_fire"] = ["1 x"]
+
+            st.pills(
+                "🔥 Fire multiplier",
+                ["0.25 x", "0.5 x", "1 x", "2 x", "4 x"],
+                selection_mode="multi",
+                key=f"plot_{i}_fire")
+
+            st.multiselect(
+                "Soundings to plot",
+                options=list(ss.all_soundings.keys()),
+                key=f"plot_{i}_soundings",
+            )
+
+    elif isinstance(plot, SkewPlot):
+        if f"plot_{i}_runs" not in ss:
+            ss[f"plot_{i}_runs"] = [ss.all_runs_key]
+        if f"plot_{i}_soundings" not in ss:
+            ss[f"plot_{i}_soundings"] = []
+
+        if f"plot_{i}_time" in ss:
+            plot.time_plot = ss[f"plot_{i}_time"]
+
+        plot.selected_runs = ss[f"plot_{i}_runs"]
+
+        with st.container(border=True):
+            col1, col2 = st.columns([2, 1])
+            col1.header(f":material/partly_cloudy_day: Plot {i}")
+            col2.button(
+                "",
+                icon=":material/delete:",
+                use_container_width=True,
+                key=f"plot_{i}_delete",
+                on_click=process_delete_plot,
+                args=(i,)
+            )
+
+            # Prevent the slider to select a value that does not exist.
+            if not ss[f"plot_{i}_runs"]:
+                time_max = 1.0
+                time_plot = 0.0
+            else:
+                time_max = ss.all_runs[ss[f"plot_{i}_runs"][0]].output.time[-1]
+                time_plot = plot.time_plot
+
+            st.slider("Time", 0.0, time_max, time_plot, 0.25, key=f"plot_{i}_time")
+
+            st.toggle(
+                "Animate",
+                help="Precompute all output times, to scrub the time in the plot without reruns",
+                key=f"plot_{i}_animate")
+
+            st.multiselect(
+                "Runs to plot",
+                options=list(ss.all_runs.keys()),
+                key=f"plot_{i}_runs",
+            )
+
+            if f"plot_{i}_fire" not in ss:
+                ss[f"plot_{i}_fire"] = ["1 x"]
+
+            st.pills(
+                "🔥 Fire multiplier",
+                ["0.25 x", "0.5 x", "1 x", "2 x", "4 x"],
+                selection_mode="multi",
+                key=f"plot_{i}_fire")
+
+            st.multiselect(
+                "Soundings to plot",
+                options=list(ss.all_soundings.keys()),
+                key=f"plot_{i}_soundings",
+            )
+
+
+# Subheader, figure and notes of plot i.
+def show_plot(i, plot):
+    if isinstance(plot, LinePlot):
+        st.subheader(f":material/line_axis: Plot {i}")
+        build_figure = build_line_figure
+    elif isinstance(plot, ProfilePlot):
+        st.subheader(f":material/expand: Plot {i}")
+        build_figure = build_profile_figure
+    elif isinstance(plot, PlumePlot):
+        st.subheader(f":material/local_fire_department: Plot {i}")
+        build_figure = build_plume_figure
+    elif isinstance(plot, SkewPlot):
+        st.subheader(f":material/partly_cloudy_day: Plot {i}")
+        build_figure = build_skew_figure
+
+    # Reuse the figure if none of its inputs changed since it was built.
+    figure_key = calc_figure_key(i, plot)
+    figure = figure_cache.get(figure_key)
+    if figure is None:
+        figure = build_figure(i, plot)
+        figure_cache.put(figure_key, figure)
+    fig, notes = figure
+
+    for toast in notes.get("toasts", []):
+        st.toast(toast)
+
+    st.plotly_chart(fig, key=f"plot_{i}_plotly")
+
+    if notes.get("parcel_rows"):
+        st.dataframe(pd.DataFrame(notes["parcel_rows"]), hide_index=True, key=f"plot_{i}_parcels")
+
+    for warning in notes.get("warnings", []):
+        st.caption(f":material/warning: {warning}")
+
+
+# Each plot is a fragment, so that interacting with its controls reruns only this plot and not the whole app.
+# The controls are drawn in the sidebar and the plot in its placeholder in the main area, if it is shown.
+@st.fragment
+def plot_fragment(i, placeholder):
+    # The plot was deleted from within the fragment, the rest of the app needs to be updated.
+    if i not in ss.all_plots:
+        st.rerun()
+
+    plot = ss.all_plots[i]
+    show_plot_controls(i, plot)
+
+    if placeholder is not None:
+        with placeholder.container(border=True):
+            show_plot(i, plot)
+
+
 # Load the default settings from disk.
 if "default_name" not in ss:
     with open(f"default_settings.toml", "rb") as f:
@@ -250,6 +1201,7 @@ if "c" in st.query_params:
 
     # Get the run settings.
     if "settings" in url_data:
+        url_runs = {}
         try:
             ds = url_data["settings"]
 
@@ -271,6 +1223,15 @@ if "c" in st.query_params:
 
                 url_settings["dt"] = float(d["dt"])
                 url_settings["dt_output"] = float(d["dt_output"])
+                if "integrator" in d:
+                    url_settings["integrator"] = str(d["integrator"])
+                if "plume_grid" in d:
+                    url_settings["plume_grid"] = str(d["plume_grid"])
+                if "plume_dz" in d:
+                    url_settings["plume_dz"] = float(d["plume_dz"])
+                for key in plume_closure_settings:
+                    if key in d:
+                        url_settings[key] = float(d[key])
 
                 url_settings["h"] = float(d["h"])
                 url_settings["beta"] = float(d["beta"])
@@ -290,15 +1251,32 @@ if "c" in st.query_params:
                 url_settings["dq_plume"] = float(d["dq_plume"])
 
                 # Input is valid, overwrite the defaults.
-                color_index = ss.available_colors.pop(0)
-                ss.all_runs[run_name] = MixedLayerModel(url_settings, color_index)
-
-                if ss.all_runs_key == None:
-                    ss.all_runs_key = run_name
+                url_runs[run_name] = url_settings
 
         except KeyError:
             st.warning("The provided settings via the URL are incomplete or corrupt, reverting to default settings")
 
+        # Integrate all valid runs in one batch. If that fails, the runs are integrated one by one and
+        # the runs that cannot be integrated are skipped.
+        color_indices = [ ss.available_colors.pop(0) for _ in url_runs ]
+        try:
+            loaded_runs = dict(zip(url_runs.keys(), run_mixed_layer_batch(list(url_runs.values()), color_indices)))
+        except ArithmeticError:
+            loaded_runs = {}
+            for (run_name, url_settings), color_index in zip(url_runs.items(), color_indices):
+                try:
+                    loaded_runs[run_name] = MixedLayerModel(url_settings, color_index)
+                except ArithmeticError as error:
+                    st.warning(f"Run {run_name} provided via the URL cannot be integrated, not loaded ({error})")
+                    ss.available_colors.append(color_index)
+            ss.available_colors.sort()
+
+        for run_name, run in loaded_runs.items():
+            ss.all_runs[run_name] = run
+
+            if ss.all_runs_key == None:
+                ss.all_runs_key = run_name
+
     # Get the provided sounding.
     if "soundings" in url_data:
         try:
@@ -355,7 +1333,27 @@ if "run_name_input" in ss:
 # Check the range of plot_times.
 ss.time_max = 0
 for _, run in ss.all_runs.items():
-    ss.time_max = max(ss.time_max, run.output.time.values[-1])
+    ss.time_max = max(ss.time_max, run.output.time[-1])
+
+
+# Layout of the plots in the main area, the plots are drawn into their placeholder by plot_fragment.
+plot_placeholders = {}
+if ss.main_mode == MainMode.PLOT:
+    if "plots_number" not in ss:
+        ss.plots_number = 1
+
+    with st.expander("Plot settings", expanded=False):
+        col_radio, col_focus = st.columns(2)
+        col_radio.radio("Number of columns", [1, 2, 3, 4], horizontal=True, key="plots_number")
+        col_focus.pills("Focus on plots", selection_mode="multi", options=ss.all_plots, key="plots_focus")
+        figure_cache_stats = st.empty()
+
+    plots_to_show = ss.plots_focus if len(ss.plots_focus) > 0 else list(ss.all_plots.keys())
+
+    ncols = ss.plots_number
+    cols = st.columns(ncols)
+    for n, i in enumerate(plots_to_show):
+        plot_placeholders[i] = cols[n % ncols].empty()
 
 
 # Side bar.
@@ -372,8 +1370,9 @@ with st.sidebar:
         on_change=process_selected_run
     )
 
-    clone_run, edit_run, delete_run = st.columns(3)
+    clone_run, fork_run, edit_run, delete_run = st.columns(4)
     clone_run.button("", icon=":material/content_copy:", use_container_width=True, on_click=process_clone_run)
+    fork_run.button("", help="Fork run at a given time", icon=":material/call_split:", use_container_width=True, on_click=process_fork_run)
     edit_run.button("", icon=":material/edit:", use_container_width=True, on_click=process_edit_run)
     delete_run.button("", icon=":material/delete:", use_container_width=True, on_click=process_delete_run)
 
@@ -406,205 +1405,8 @@ with st.sidebar:
         use_container_width=True,
         on_click=process_new_skew_plot)
 
-    for i, plot in ss.all_plots.items():
-        if isinstance(plot, LinePlot):
-            if f"plot_{i}_runs" not in ss:
-                ss[f"plot_{i}_runs"] = list(ss.all_runs.keys())
-
-            # Update plot state BEFORE rendering selectboxes
-            if f"plot_{i}_xaxis" in ss:
-                plot.xaxis_key = ss[f"plot_{i}_xaxis"]
-                plot.xaxis_index = plot.xaxis_options.index(plot.xaxis_key)
-
-            if f"plot_{i}_yaxis" in ss:
-                plot.yaxis_key = ss[f"plot_{i}_yaxis"]
-                plot.yaxis_index = plot.yaxis_options.index(plot.yaxis_key)
-
-            plot.selected_runs = ss[f"plot_{i}_runs"]
-
-            with st.container(border=True):
-                col1, col2 = st.columns([2, 1])
-                col1.header(f":material/line_axis: Plot {i}")
-                col2.button(
-                        "",
-                        icon=":material/delete:",
-                        use_container_width=True,
-                        key=f"plot_{i}_delete",
-                        on_click=process_delete_plot,
-                        args=(i,)
-                )
-
-                x_axis, y_axis = st.columns(2)
-                x_axis.selectbox("X-axis", plot.xaxis_options, index=plot.xaxis_index, key=f"plot_{i}_xaxis")
-                y_axis.selectbox("Y-axis", plot.yaxis_options, index=plot.yaxis_index, key=f"plot_{i}_yaxis")
-
-                st.multiselect(
-                    "Runs to plot",
-                    options=list(ss.all_runs.keys()),
-                    key=f"plot_{i}_runs",
-                )
-
-        elif isinstance(plot, ProfilePlot):
-            if f"plot_{i}_runs" not in ss:
-                ss[f"plot_{i}_runs"] = list(ss.all_runs.keys())
-            if f"plot_{i}_soundings" not in ss:
-                ss[f"plot_{i}_soundings"] = []
-
-            # Update plot state BEFORE rendering selectboxes
-            if f"plot_{i}_xaxis" in ss:
-                plot.xaxis_key = ss[f"plot_{i}_xaxis"]
-                plot.xaxis_index = plot.xaxis_options.index(plot.xaxis_key)
-
-            if f"plot_{i}_time" in ss:
-                plot.time_plot = ss[f"plot_{i}_time"]
-
-            plot.selected_runs = ss[f"plot_{i}_runs"]
-
-            with st.container(border=True):
-                col1, col2 = st.columns([2, 1])
-                col1.header(f":material/expand: Plot {i}")
-                col2.button(
-                    "",
-                    icon=":material/delete:",
-                    use_container_width=True,
-                    key=f"plot_{i}_delete",
-                    on_click=process_delete_plot,
-                    args=(i,)
-                )
-
-                x_axis, time_slider = st.columns(2)
-                x_axis.selectbox("X-axis", plot.xaxis_options, index=plot.xaxis_index, key=f"plot_{i}_xaxis")
-
-                time_slider.slider("Time", 0.0, ss.time_max, plot.time_plot, 0.25, key=f"plot_{i}_time")
-
-                st.multiselect(
-                    "Runs to plot",
-                    options=list(ss.all_runs.keys()),
-                    key=f"plot_{i}_runs",
-                )
-
-                st.multiselect(
-                    "Soundings to plot",
-                    options=list(ss.all_soundings.keys()),
-                    key=f"plot_{i}_soundings",
-                )
-
-
-        elif isinstance(plot, PlumePlot):
-            if f"plot_{i}_runs" not in ss:
-                ss[f"plot_{i}_runs"] = [ss.all_runs_key]
-            if f"plot_{i}_soundings" not in ss:
-                ss[f"plot_{i}_soundings"] = []
-
-            # Update plot state BEFORE rendering selectboxes
-            if f"plot_{i}_xaxis" in ss:
-                plot.xaxis_key = ss[f"plot_{i}_xaxis"]
-                plot.xaxis_index = plot.xaxis_options.index(plot.xaxis_key)
-
-            if f"plot_{i}_time" in ss:
-                plot.time_plot = ss[f"plot_{i}_time"]
-
-            plot.selected_runs = ss[f"plot_{i}_runs"]
-
-            with st.container(border=True):
-                col1, col2 = st.columns([2, 1])
-                col1.header(f":material/local_fire_department: Plot {i}")
-                col2.button(
-                    "",
-                    icon=":material/delete:",
-                    use_container_width=True,
-                    key=f"plot_{i}_delete",
-                    on_click=process_delete_plot,
-                    args=(i,)
-                )
-
-                x_axis, time_slider = st.columns(2)
-                x_axis.selectbox("X-axis", plot.xaxis_options, index=plot.xaxis_index, key=f"plot_{i}_xaxis")
-
-                # Prevent the slider to select a value that does not exist.
-                if not ss[f"plot_{i}_runs"]:
-                    time_max = 1.0
-                    time_plot = (0.0, 1.0)
-                else:
-                    time_max = ss.all_runs[ss[f"plot_{i}_runs"][0]].output.time.values[-1]
-                    time_plot = (0.0 if plot.time_plot[0] > time_max else plot.time_plot[0], min(time_max, plot.time_plot[1]))
-
-                time_slider.slider("Time", 0.0, time_max, time_plot, 0.25, key=f"plot_{i}_time")
-
-                st.multiselect(
-                    "Runs to plot",
-                    options=list(ss.all_runs.keys()),
-                    key=f"plot_{i}_runs",
-                )
-
-                if f"plot_{i}_fire" not in ss:
-                    ss[f"plot_{i}_fire"] = ["1 x"]
-
-                st.pills(
-                    "🔥 Fire multiplier",
-                    ["0.25 x", "0.5 x", "1 x", "2 x", "4 x"],
-                    selection_mode="multi",
-                    key=f"plot_{i}_fire")
-
-                st.multiselect(
-                    "Soundings to plot",
-                    options=list(ss.all_soundings.keys()),
-                    key=f"plot_{i}_soundings",
-                )
-
-        elif isinstance(plot, SkewPlot):
-            if f"plot_{i}_runs" not in ss:
-                ss[f"plot_{i}_runs"] = [ss.all_runs_key]
-            if f"plot_{i}_soundings" not in ss:
-                ss[f"plot_{i}_soundings"] = []
-
-            if f"plot_{i}_time" in ss:
-                plot.time_plot = ss[f"plot_{i}_time"]
-
-            plot.selected_runs = ss[f"plot_{i}_runs"]
-
-            with st.container(border=True):
-                col1, col2 = st.columns([2, 1])
-                col1.header(f":material/partly_cloudy_day: Plot {i}")
-                col2.button(
-                    "",
-                    icon=":material/delete:",
-                    use_container_width=True,
-                    key=f"plot_{i}_delete",
-                    on_click=process_delete_plot,
-                    args=(i,)
-                )
-
-                # Prevent the slider to select a value that does not exist.
-                if not ss[f"plot_{i}_runs"]:
-                    time_max = 1.0
-                    time_plot = 0.0
-                else:
-                    time_max = ss.all_runs[ss[f"plot_{i}_runs"][0]].output.time.values[-1]
-                    time_plot = plot.time_plot
-
-                st.slider("Time", 0.0, time_max, time_plot, 0.25, key=f"plot_{i}_time")
-
-                st.multiselect(
-                    "Runs to plot",
-                    options=list(ss.all_runs.keys()),
-                    key=f"plot_{i}_runs",
-                )
-
-                if f"plot_{i}_fire" not in ss:
-                    ss[f"plot_{i}_fire"] = ["1 x"]
-
-                st.pills(
-                    "🔥 Fire multiplier",
-                    ["0.25 x", "0.5 x", "1 x", "2 x", "4 x"],
-                    selection_mode="multi",
-                    key=f"plot_{i}_fire")
-
-                st.multiselect(
-                    "Soundings to plot",
-                    options=list(ss.all_soundings.keys()),
-                    key=f"plot_{i}_soundings",
-                )
+    for i in list(ss.all_plots.keys()):
+        plot_fragment(i, plot_placeholders.get(i))
 
     st.divider()
 
@@ -627,646 +1429,8 @@ with st.sidebar:
 
 
 if ss.main_mode == MainMode.PLOT:
-    if "plots_number" not in ss:
-        ss.plots_number = 1
-
-    with st.expander("Plot settings", expanded=False):
-        col_radio, col_focus = st.columns(2)
-        col_radio.radio("Number of columns", [1, 2, 3, 4], horizontal=True, key="plots_number")
-        col_focus.pills("Focus on plots", selection_mode="multi", options=ss.all_plots, key="plots_focus")
-
-    plots_to_show = ss.plots_focus if len(ss.plots_focus) > 0 else list(ss.all_plots.keys())
-
-    n = 0
-    ncols = ss.plots_number
-    cols = st.columns(ncols)
-    for i in plots_to_show:
-        plot = ss.all_plots[i]
-        col = cols[n % ncols]
-        n += 1
-        with col.container(border=True):
-
-            if isinstance(plot, LinePlot):
-                st.subheader(f":material/line_axis: Plot {i}")
-                fig = go.Figure()
-                for run_name in plot.selected_runs:
-                    run = ss.all_runs[run_name]
-                    fig.add_trace(
-                        go.Scatter(
-                            x=run.output[plot.xaxis_key],
-                            y=run.output[plot.yaxis_key],
-                            mode="lines+markers", name=run_name,
-                            line=dict(color=color_cycle[run.color_index % len(color_cycle)])
-                        )
-                    )
-
-                fig.update_traces(showlegend=True)
-                fig.update_layout(
-                    margin={"t": 50, "l": 0, "b": 0, "r": 0},
-                    xaxis_title=plot.xaxis_key,
-                    yaxis_title=plot.yaxis_key,
-                    xaxis_title_font_size=plot_font_size,
-                    xaxis_tickfont_size=plot_font_size,
-                    yaxis_title_font_size=plot_font_size,
-                    yaxis_tickfont_size=plot_font_size,
-                    legend_font_size=plot_font_size,
-                )
-                st.plotly_chart(fig, key=f"plot_{i}_plotly")
-
-            elif isinstance(plot, ProfilePlot):
-                st.subheader(f":material/expand: Plot {i}")
-                fig = go.Figure()
-
-                # Get the plot ranges
-                theta_min = 1e9
-                theta_max = -1e9
-                h_max = -1e9
-
-                for run_name in plot.selected_runs:
-                    run = ss.all_runs[run_name]
-                    h_max = max(h_max, run.output.h.max())
-                    theta_min = min(theta_min, run.output.theta.min())
-
-                h_max *= 1.35
-
-                for run_name in plot.selected_runs:
-                    run = ss.all_runs[run_name]
-                    theta_max_run = (run.output.theta + run.output.dtheta + run.gammatheta*(h_max-run.output.h)).max()
-                    theta_max = max(theta_max, theta_max_run)
-
-                # Plot the profiles.
-                for run_name in plot.selected_runs:
-                    run = ss.all_runs[run_name]
-
-                    # Plot the reference state
-                    time_plot = plot.time_plot[0] * 3600
-                    if time_plot <= run.runtime:
-                        idx = round(time_plot / run.dt_output)
-
-                        h = run.output.h.values[idx]
-
-                        if plot.xaxis_key == "theta":
-                            theta = run.output.theta.values[idx]
-                            dtheta = run.output.dtheta.values[idx]
-                            gammatheta = run.gammatheta
-                            x_plot = [theta, theta, theta + dtheta, theta + dtheta + gammatheta*(h_max-h)]
-
-                        elif plot.xaxis_key == "q":
-                            q = run.output.q.values[idx]
-                            dq = run.output.dq.values[idx]
-                            gammaq = run.gammaq * 1e3
-                            x_plot = [q, q, q + dq, q + dq + gammaq*(h_max-h)]
-
-                        elif plot.xaxis_key == "thetav":
-                            theta = run.output.theta.values[idx]
-                            dtheta = run.output.dtheta.values[idx]
-                            gammatheta = run.gammatheta
-
-                            q = run.output.q.values[idx] * 1e-3
-                            dq = run.output.dq.values[idx] * 1e-3
-                            gammaq = run.gammaq
-
-                            x_plot = [
-                                virtual_temperature(theta, q, 0.0),
-                                virtual_temperature(theta, q, 0.0),
-                                virtual_temperature(theta + dtheta, q + dq, 0.0),
-                                virtual_temperature(theta + dtheta + gammatheta*(h_max-h), q + dq + gammaq*(h_max-h), 0.0)
-                            ]
-
-                        z_plot = [0, h, h, h_max]
-
-                        fig.add_trace(
-                            go.Scatter(
-                                x=x_plot,
-                                y=z_plot,
-                                mode="lines+markers",
-                                showlegend=False,
-                                name=None,
-                                line=dict(color=color_cycle[run.color_index % len(color_cycle)], dash="dot"),
-                            )
-                        )
-
-                    # Plot the actual state if available.
-                    time_plot = plot.time_plot[1] * 3600
-                    if time_plot <= run.runtime:
-                        idx = round(time_plot / run.dt_output)
-
-                        h = run.output.h.values[idx]
-
-                        if plot.xaxis_key == "theta":
-                            theta = run.output.theta.values[idx]
-                            dtheta = run.output.dtheta.values[idx]
-                            gammatheta = run.gammatheta
-                            x_plot = [theta, theta, theta + dtheta, theta + dtheta + gammatheta*(h_max-h)]
-
-                        elif plot.xaxis_key == "q":
-                            q = run.output.q.values[idx]
-                            dq = run.output.dq.values[idx]
-                            gammaq = run.gammaq * 1e3
-                            x_plot = [q, q, q + dq, q + dq + gammaq*(h_max-h)]
-
-                        elif plot.xaxis_key == "thetav":
-                            theta = run.output.theta.values[idx]
-                            dtheta = run.output.dtheta.values[idx]
-                            gammatheta = run.gammatheta
-
-                            q = run.output.q.values[idx] * 1e-3
-                            dq = run.output.dq.values[idx] * 1e-3
-                            gammaq = run.gammaq
-
-                            x_plot = [
-                                virtual_temperature(theta, q, 0.0),
-                                virtual_temperature(theta, q, 0.0),
-                                virtual_temperature(theta + dtheta, q + dq, 0.0),
-                                virtual_temperature(theta + dtheta + gammatheta*(h_max-h), q + dq + gammaq*(h_max-h), 0.0)
-                            ]
-
-                        z_plot = [0, h, h, h_max]
-
-                        fig.add_trace(
-                            go.Scatter(
-                                x=x_plot,
-                                y=z_plot,
-                                mode="lines+markers",
-                                showlegend=True,
-                                name=run_name,
-                                line=dict(color=color_cycle[run.color_index % len(color_cycle)])
-                            )
-                        )
-
-                for sounding_name in ss[f"plot_{i}_soundings"]:
-                    sounding_df = ss.all_soundings[sounding_name]
-
-                    if plot.xaxis_key not in sounding_df.columns:
-                        st.toast(f"Requested variable \"{plot.xaxis_key}\" is not in sounding \"{sounding_name}\"")
-
-                    else:
-                        fig.add_trace(
-                            go.Scatter(
-                                x=sounding_df[plot.xaxis_key],
-                                y=sounding_df["z"],
-                                mode="markers",
-                                showlegend=True,
-                                name=sounding_name,
-                                marker=dict(
-                                    color="black",
-                                    symbol="cross",
-                                    size=3,
-                                    )
-                            )
-                        )
-
-                fig.update_layout(
-                    margin={"t": 50, "l": 0, "b": 0, "r": 0},
-                    xaxis_title=plot.xaxis_key,
-                    yaxis_title="z",
-                    xaxis_title_font_size=plot_font_size,
-                    xaxis_tickfont_size=plot_font_size,
-                    yaxis_title_font_size=plot_font_size,
-                    yaxis_tickfont_size=plot_font_size,
-                    legend_font_size=plot_font_size,
-                )
-                st.plotly_chart(fig, key=f"plot_{i}_plotly")
-
-            elif isinstance(plot, PlumePlot):
-                st.subheader(f":material/local_fire_department: Plot {i}")
-                fig = go.Figure()
-
-                # Get the plot ranges
-                h_max = -1e9
-
-                for run_name in plot.selected_runs:
-                    run = ss.all_runs[run_name]
-                    h_max = max(h_max, run.output.h.max())
-
-                h_max *= 2.0
-
-                # Plot the profiles.
-                for run_name in plot.selected_runs:
-                    run = ss.all_runs[run_name]
-
-                    # If they are the same, double plotting is not necessary.
-                    if plot.time_plot[0] != plot.time_plot[1]:
-
-                        # Plot the reference state
-                        time_plot = plot.time_plot[0] * 3600
-                        if time_plot <= run.runtime:
-                            idx = round(time_plot / run.dt_output)
-
-                            h = run.output.h.values[idx]
-
-                            if plot.xaxis_key == "theta":
-                                theta = run.output.theta.values[idx]
-                                dtheta = run.output.dtheta.values[idx]
-                                gammatheta = run.gammatheta
-                                x_plot = [theta, theta, theta + dtheta, theta + dtheta + gammatheta*(h_max-h)]
-
-                            elif plot.xaxis_key == "q":
-                                q = run.output.q.values[idx]
-                                dq = run.output.dq.values[idx]
-                                gammaq = run.gammaq * 1e3
-                                x_plot = [q, q, q + dq, q + dq + gammaq*(h_max-h)]
-
-                            elif plot.xaxis_key == "thetav":
-                                theta = run.output.theta.values[idx]
-                                dtheta = run.output.dtheta.values[idx]
-                                gammatheta = run.gammatheta
-
-                                q = run.output.q.values[idx] * 1e-3
-                                dq = run.output.dq.values[idx] * 1e-3
-                                gammaq = run.gammaq
-
-                                x_plot = [
-                                    virtual_temperature(theta, q, 0.0),
-                                    virtual_temperature(theta, q, 0.0),
-                                    virtual_temperature(theta + dtheta, q + dq, 0.0),
-                                    virtual_temperature(theta + dtheta + gammatheta*(h_max-h), q + dq + gammaq*(h_max-h), 0.0)
-                                ]
-
-                            elif plot.xaxis_key == "w":
-                                x_plot = np.array([np.nan, np.nan, np.nan, np.nan])
-
-                            z_plot = [0, h, h, h_max]
-
-                            fig.add_trace(
-                                go.Scatter(
-                                    x=x_plot,
-                                    y=z_plot,
-                                    mode="lines+markers",
-                                    showlegend=False,
-                                    name=None,
-                                    line=dict(color=color_cycle[run.color_index % len(color_cycle)], dash="dot"),
-                                )
-                            )
-
-                            ss[f"plot_{i}_fire"].sort()
-
-                            for fire_label in ss[f"plot_{i}_fire"]:
-                                if fire_label == "0.25 x":
-                                    fac_fire = 0.25
-                                    color = "#781c6d"
-                                elif fire_label == "0.5 x":
-                                    fac_fire = 0.5
-                                    color = "#bc3754"
-                                elif fire_label == "1 x":
-                                    fac_fire = 1.0
-                                    color = "#dd513a"
-                                elif fire_label == "2 x":
-                                    fac_fire = 2.0
-                                    color = "#f37819"
-                                elif fire_label == "4 x":
-                                    fac_fire = 4.0
-                                    color = "#fca50a"
-
-                                if plot.xaxis_key == "theta":
-                                    x_plot, _, _, type_plume, z_plot, _ = run.launch_entraining_plume(time_plot, fac_fire)
-                                elif plot.xaxis_key == "q":
-                                    _, x_plot, _, type_plume, z_plot, _ = run.launch_entraining_plume(time_plot, fac_fire)
-                                elif plot.xaxis_key == "thetav":
-                                    _, _, x_plot, type_plume, z_plot, _ = run.launch_entraining_plume(time_plot, fac_fire)
-                                elif plot.xaxis_key == "w":
-                                    _, _, _, type_plume, z_plot, x_plot = run.launch_entraining_plume(time_plot, fac_fire)
-
-
-                                marker_sizes = np.zeros_like(z_plot)
-                                marker_sizes[::5] = np.where(type_plume[::5] > 0, 5, marker_sizes[::5])
-                                marker_sizes[0], marker_sizes[-1] = 5, 5
-
-                                fig.add_trace(
-                                    go.Scatter(
-                                        x=x_plot,
-                                        y=z_plot,
-                                        mode="lines+markers",
-                                        showlegend=False,
-                                        line=dict(
-                                            color=color,
-                                            dash="dot",
-                                            width=1.5,
-                                            ),
-                                        marker=dict(
-                                            color=color,
-                                            # symbol="cross",
-                                            size=marker_sizes,
-                                            )
-                                    )
-                                )
-
-                    # Plot the actual state if available.
-                    time_plot = plot.time_plot[1] * 3600
-                    if time_plot <= run.runtime:
-                        idx = round(time_plot / run.dt_output)
-
-                        h = run.output.h.values[idx]
-
-                        if plot.xaxis_key == "theta":
-                            theta = run.output.theta.values[idx]
-                            dtheta = run.output.dtheta.values[idx]
-                            gammatheta = run.gammatheta
-                            x_plot = [theta, theta, theta + dtheta, theta + dtheta + gammatheta*(h_max-h)]
-
-                        elif plot.xaxis_key == "q":
-                            q = run.output.q.values[idx]
-                            dq = run.output.dq.values[idx]
-                            gammaq = run.gammaq * 1e3
-                            x_plot = [q, q, q + dq, q + dq + gammaq*(h_max-h)]
-
-                        elif plot.xaxis_key == "thetav":
-                            theta = run.output.theta.values[idx]
-                            dtheta = run.output.dtheta.values[idx]
-                            gammatheta = run.gammatheta
-
-                            # Convert back to kg/kg
-                            q = run.output.q.values[idx] * 1e-3
-                            dq = run.output.dq.values[idx] * 1e-3
-                            gammaq = run.gammaq
-
-                            x_plot = [
-                                virtual_temperature(theta, q, 0.0),
-                                virtual_temperature(theta, q, 0.0),
-                                virtual_temperature(theta + dtheta, q + dq, 0.0),
-                                virtual_temperature(theta + dtheta + gammatheta*(h_max-h), q + dq + gammaq*(h_max-h), 0.0)
-                            ]
-
-                        elif plot.xaxis_key == "w":
-                            x_plot = np.array([np.nan, np.nan, np.nan, np.nan])
-
-                        z_plot = [0, h, h, h_max]
-
-                        fig.add_trace(
-                            go.Scatter(
-                                x=x_plot,
-                                y=z_plot,
-                                mode="lines+markers",
-                                showlegend=True,
-                                name=run_name,
-                                line=dict(color=color_cycle[run.color_index % len(color_cycle)])
-                            )
-                        )
-
-                        ss[f"plot_{i}_fire"].sort()
-
-                        for fire_label in ss[f"plot_{i}_fire"]:
-                            if fire_label == "0.25 x":
-                                fac_fire = 0.25
-                                color = "#781c6d"
-                            elif fire_label == "0.5 x":
-                                fac_fire = 0.5
-                                color = "#bc3754"
-                            elif fire_label == "1 x":
-                                fac_fire = 1.0
-                                color = "#dd513a"
-                            elif fire_label == "2 x":
-                                fac_fire = 2.0
-                                color = "#f37819"
-                            elif fire_label == "4 x":
-                                fac_fire = 4.0
-                                color = "#fca50a"
-
-                            if plot.xaxis_key == "theta":
-                                x_plot, _, _, type_plume, z_plot, _ = run.launch_entraining_plume(time_plot, fac_fire)
-                            elif plot.xaxis_key == "q":
-                                _, x_plot, _, type_plume, z_plot, _ = run.launch_entraining_plume(time_plot, fac_fire)
-                            elif plot.xaxis_key == "thetav":
-                                _, _, x_plot, type_plume, z_plot, _ = run.launch_entraining_plume(time_plot, fac_fire)
-                            elif plot.xaxis_key == "w":
-                                _, _, _, type_plume, z_plot, x_plot = run.launch_entraining_plume(time_plot, fac_fire)
-
-                            marker_sizes = np.zeros_like(z_plot)
-                            marker_sizes[::5] = np.where(type_plume[::5] > 0, 5, marker_sizes[::5])
-                            marker_sizes[0], marker_sizes[-1] = 5, 5
-
-                            fig.add_trace(
-                                go.Scatter(
-                                    x=x_plot,
-                                    y=z_plot,
-                                    mode="lines+markers",
-                                    showlegend=True,
-                                    name=f"🔥 {fire_label}",
-                                    line=dict(
-                                        color=color,
-                                        width=1.5,
-                                        ),
-                                    marker=dict(
-                                        color=color,
-                                        # symbol="cross",
-                                        size=marker_sizes,
-                                        )
-                                )
-                            )
-
-                for sounding_name in ss[f"plot_{i}_soundings"]:
-                    sounding_df = ss.all_soundings[sounding_name]
-
-                    if plot.xaxis_key not in sounding_df.columns:
-                        st.toast(f"Requested variable \"{plot.xaxis_key}\" is not in sounding \"{sounding_name}\"")
-
-                    else:
-                        fig.add_trace(
-                            go.Scatter(
-                                x=sounding_df[plot.xaxis_key],
-                                y=sounding_df["z"],
-                                mode="markers",
-                                showlegend=True,
-                                name=sounding_name,
-                                marker=dict(
-                                    color="black",
-                                    symbol="cross",
-                                    size=3,
-                                    )
-                            )
-                        )
-
-                fig.update_layout(
-                    margin={"t": 50, "l": 0, "b": 0, "r": 0},
-                    xaxis_title=plot.xaxis_key,
-                    yaxis_title="z",
-                    xaxis_title_font_size=plot_font_size,
-                    xaxis_tickfont_size=plot_font_size,
-                    yaxis_title_font_size=plot_font_size,
-                    yaxis_tickfont_size=plot_font_size,
-                    legend_font_size=plot_font_size,
-                )
-                st.plotly_chart(fig, key=f"plot_{i}_plotly")
-
-            elif isinstance(plot, SkewPlot):
-                st.subheader(f":material/partly_cloudy_day: Plot {i}")
-                fig = go.Figure()
-                p_levels = np.array([1000, 850, 700, 500, 400, 300, 250, 200, 100])
-                temp_range = np.arange(-90, 51, 10)
-
-                ## ADD BACKGROUND LINES
-                # Add isotherms (constant temperature lines)
-                for temp in temp_range:
-                    skewed_temps = [skew_transform(temp, p) for p in p_levels]
-                    fig.add_trace(go.Scatter(
-                        x=skewed_temps,
-                        y=p_levels,
-                        mode='lines',
-                        line=dict(color='red', width=0.5, dash='solid'),
-                        name=f'{temp}°C isotherm',
-                        showlegend=False,
-                        hoverinfo="none",
-                    ))
-
-                # Add dry adiabats (constant potential temperature)
-                theta_levels = np.arange(200, 500, 20)  # Potential temperature in K
-
-                for theta in theta_levels:
-                    temps = []
-                    pressures = []
-                    for p in np.logspace(2, 3, 50):  # 100 to 1000 hPa
-                        if p <= 1000:
-                            # Calculate temperature from potential temperature
-                            # θ = T * (1000/P)^0.286
-                            temp_k = theta * (p/1000)**0.286
-                            temp_c = temp_k - 273.15
-                            if -90 <= temp_c <= 50:  # Reasonable temperature range
-                                temps.append(skew_transform(temp_c, p))
-                                pressures.append(p)
-
-                    if temps:
-                        fig.add_trace(go.Scatter(
-                            x=temps,
-                            y=pressures,
-                            mode='lines',
-                            line=dict(color='green', width=0.6, dash='dash'),
-                            name=f'{theta}K dry adiabat',
-                            showlegend=False,
-                            hoverinfo="none",
-                        ))
-                ## FINISH BACKGROUND LINES
-
-
-                # Plot the profiles.
-                for run_name in plot.selected_runs:
-                    run = ss.all_runs[run_name]
-
-                    # Plot the sounding.
-                    time_plot = plot.time_plot * 3600
-                    if time_plot <= run.runtime:
-                        idx = round(time_plot / run.dt_output)
-
-                        sounding_pressure, sounding_temp, sounding_dewpoint = calc_skew_lines(
-                            run.output.h[idx],
-                            run.output.theta[idx],
-                            run.output.dtheta[idx],
-                            run.gammatheta,
-                            run.output.q[idx] * 1e-3,
-                            run.output.dq[idx] * 1e-3,
-                            run.gammaq,
-                            1e5,
-                        )
-
-                        skewed_temp = [skew_transform(t, p) for t, p in zip(sounding_temp, sounding_pressure)]
-                        skewed_dewpoint = [skew_transform(d, p) for d, p in zip(sounding_dewpoint, sounding_pressure)]
-
-                        fig.add_trace(
-                            go.Scatter(
-                                x=skewed_temp,
-                                y=sounding_pressure,
-                                mode="lines",
-                                line=dict(color=color_cycle[run.color_index % len(color_cycle)]),
-                                name=f"{run_name} (T)",
-                                hovertemplate='Temperature: %{customdata}°C<br>Pressure: %{y} hPa<extra></extra>',
-                                customdata=sounding_temp
-                            )
-                        )
-
-                        fig.add_trace(
-                            go.Scatter(
-                                x=skewed_dewpoint,
-                                y=sounding_pressure,
-                                mode='lines',
-                                name=f"{run_name} (Td)",
-                                # showlegend=False,
-                                line=dict(color=color_cycle[run.color_index % len(color_cycle)], dash="dot"),
-                                hovertemplate='Dewpoint: %{customdata}°C<br>Pressure: %{y} hPa<extra></extra>',
-                                customdata=sounding_dewpoint
-                        ))
-
-
-                        ss[f"plot_{i}_fire"].sort()
-
-                        for fire_label in ss[f"plot_{i}_fire"]:
-                            if fire_label == "0.25 x":
-                                fac_fire = 0.25
-                                color = "#781c6d"
-                            elif fire_label == "0.5 x":
-                                fac_fire = 0.5
-                                color = "#bc3754"
-                            elif fire_label == "1 x":
-                                fac_fire = 1.0
-                                color = "#dd513a"
-                            elif fire_label == "2 x":
-                                fac_fire = 2.0
-                                color = "#f37819"
-                            elif fire_label == "4 x":
-                                fac_fire = 4.0
-                                color = "#fca50a"
-
-                            x_plot, type_plume, z_plot = run.launch_entraining_plume(time_plot, fac_fire, True)
-                            x_plot = [skew_transform(t, p) for t, p in zip(x_plot, z_plot)]
-
-                            marker_sizes = np.zeros_like(z_plot)
-                            marker_sizes[::5] = np.where(type_plume[::5] > 0, 5, marker_sizes[::5])
-                            marker_sizes[0], marker_sizes[-1] = 5, 5
-
-                            fig.add_trace(
-                                go.Scatter(
-                                    x=x_plot,
-                                    y=z_plot,
-                                    mode="lines+markers",
-                                    showlegend=True,
-                                    name=f"🔥 {fire_label}",
-                                    line=dict(
-                                        color=color,
-                                        width=1.5,
-                                        ),
-                                    marker=dict(
-                                        color=color,
-                                        size=marker_sizes,
-                                        )
-                                )
-                            )
-
-                # for sounding_name in ss[f"plot_{i}_soundings"]:
-                #     sounding_df = ss.all_soundings[sounding_name]
-
-                #     if plot.xaxis_key not in sounding_df.columns:
-                #         st.toast(f"Requested variable \"{plot.xaxis_key}\" is not in sounding \"{sounding_name}\"")
-
-                #     else:
-                #         fig.add_trace(
-                #             go.Scatter(
-                #                 x=sounding_df[plot.xaxis_key],
-                #                 y=sounding_df["z"],
-                #                 mode="markers",
-                #                 showlegend=True,
-                #                 name=sounding_name,
-                #                 marker=dict(
-                #                     color="black",
-                #                     symbol="cross",
-                #                     size=3,
-                #                     )
-                #             )
-                #         )
-
-                fig.update_layout(
-                    margin={"t": 50, "l": 0, "b": 0, "r": 0},
-                    xaxis_title="temperature (°C)",
-                    yaxis_title="p (hPa)",
-                    yaxis_type="log",
-                    xaxis_range = [-40, 50],
-                    yaxis_range = [np.log10(1040), np.log10(490)],
-                    yaxis_autorange=False,
-                    xaxis_title_font_size=plot_font_size,
-                    xaxis_tickfont_size=plot_font_size,
-                    yaxis_title_font_size=plot_font_size,
-                    yaxis_tickfont_size=plot_font_size,
-                    legend_font_size=plot_font_size,
-                )
-
-                st.plotly_chart(fig, key=f"plot_{i}_plotly")
+    stats = figure_cache.stats()
+    figure_cache_stats.caption(f"Figure cache: {stats['hits']} hits, {stats['misses']} misses, {stats['entries']} figures")
 
 
 elif ss.main_mode == MainMode.EDIT:
@@ -1288,6 +1452,8 @@ elif ss.main_mode == MainMode.EDIT:
         ss.settings_general_dt = active_run.settings["dt"]
     if "settings_general_dt_output" not in ss:
         ss.settings_general_dt_output = active_run.settings["dt_output"]
+    if "settings_general_integrator" not in ss:
+        ss.settings_general_integrator = active_run.integrator
 
     if "settings_mixedlayer_h" not in ss:
         ss.settings_mixedlayer_h = active_run.settings["h"]
@@ -1318,6 +1484,13 @@ elif ss.main_mode == MainMode.EDIT:
         ss.settings_fire_atmosphere_dtheta_plume = active_run.settings["dtheta_plume"]
     if "settings_fire_atmosphere_dq_plume" not in ss:
         ss.settings_fire_atmosphere_dq_plume = active_run.settings["dq_plume"] * 1e3
+    if "settings_fire_solver_grid" not in ss:
+        ss.settings_fire_solver_grid = active_run.plume_grid
+    if "settings_fire_solver_dz" not in ss:
+        ss.settings_fire_solver_dz = active_run.plume_dz
+    for key in plume_closure_settings:
+        if f"settings_fire_closure_{key}" not in ss:
+            ss[f"settings_fire_closure_{key}"] = active_run.plume_closure[key]
 
     with st.form("edit_form", border=False):
         col1, col2, col3 = st.columns(3, vertical_alignment="bottom")
@@ -1369,6 +1542,13 @@ elif ss.main_mode == MainMode.EDIT:
                         key="settings_general_dt_output"
                     )
 
+                    st.selectbox(
+                        r"integrator",
+                        ["euler", "rk45"],
+                        help="time integration: forward Euler with fixed $\Delta t$, or adaptive Runge-Kutta 4(5) starting at $\Delta t$",
+                        key="settings_general_integrator"
+                    )
+
                 with st.expander("Mixed layer", expanded=True):
                     st.number_input(
                         r"$h$ (m)",
@@ -1486,6 +1666,146 @@ elif ss.main_mode == MainMode.EDIT:
                         key="settings_fire_atmosphere_dq_plume"
                     )
 
+            with col2:
+                with st.expander("Plume solver", expanded=True):
+                    st.selectbox(
+                        r"grid",
+                        ["uniform", "adaptive"],
+                        help="vertical grid: uniform $\Delta z$, or $\Delta z$ near the inversion and condensation level and coarser elsewhere",
+                        key="settings_fire_solver_grid"
+                    )
+
+                    st.number_input(
+                        r"$\Delta z$ (m)",
+                        help="vertical resolution of the plume (m)",
+                        min_value=1.0,
+                        step=1.0,
+                        format="%0.0f",
+                        key="settings_fire_solver_dz"
+                    )
+
+                with st.expander("Plume closure", expanded=True):
+                    st.number_input(
+                        r"$\epsilon_\textrm{plume}$ (m-1)",
+                        help="fractional entrainment factor (m-1)",
+                        step=0.0001,
+                        format="%0.4f",
+                        key="settings_fire_closure_fac_ent_plume"
+                    )
+
+                    st.number_input(
+                        r"$\beta_\textrm{plume}$ (-)",
+                        help="ratio of entrainment to detrainment (-)",
+                        step=0.05,
+                        format="%0.2f",
+                        key="settings_fire_closure_beta_plume"
+                    )
+
+                    st.number_input(
+                        r"$a_w$ (-)",
+                        help="buoyancy coefficient of the plume velocity equation (-)",
+                        step=0.1,
+                        format="%0.1f",
+                        key="settings_fire_closure_a_w_plume"
+                    )
+
+                    st.number_input(
+                        r"$b_w$ (-)",
+                        help="drag coefficient of the plume velocity equation (-)",
+                        step=0.1,
+                        format="%0.1f",
+                        key="settings_fire_closure_b_w_plume"
+                    )
+
+                    st.number_input(
+                        r"$A_\textrm{plume}$ (m2)",
+                        help="initial plume area (m2)",
+                        step=10000.0,
+                        format="%0.0f",
+                        key="settings_fire_closure_area_plume"
+                    )
+
+                    st.number_input(
+                        r"$w_\textrm{plume}$ (m s-1)",
+                        help="initial plume vertical velocity (m s-1)",
+                        step=0.1,
+                        format="%0.1f",
+                        key="settings_fire_closure_w_plume"
+                    )
+
+
+elif ss.main_mode == MainMode.FORK:
+
+    st.header("Fork run")
+
+    active_run = ss.all_runs[ss.all_runs_key]
+
+    if "fork_name_input" not in ss:
+        ss.fork_name_input = ss.all_runs_key + " (fork)"
+    if "fork_time" not in ss:
+        ss.fork_time = 0.0
+    if "fork_wtheta" not in ss:
+        ss.fork_wtheta = active_run.wtheta
+    if "fork_wq" not in ss:
+        ss.fork_wq = active_run.wq * 1e3
+    if "fork_beta" not in ss:
+        ss.fork_beta = active_run.beta
+    if "fork_div" not in ss:
+        ss.fork_div = active_run.div
+
+    with st.form("fork_form", border=False):
+        col1, col2, col3 = st.columns(3, vertical_alignment="bottom")
+
+        col1.text_input("Name of the forked run", key="fork_name_input")
+        col2.form_submit_button("Fork", on_click=process_fork_save)
+        col3.form_submit_button("Cancel", on_click=process_fork_cancel)
+
+        st.slider(
+            "Fork time (h)",
+            0.0,
+            active_run.runtime / 3600,
+            step=active_run.dt_output / 3600,
+            help="The forked run shares the output up to this time, and continues from there with the settings below",
+            key="fork_time"
+        )
+
+        col1, col2 = st.columns(2)
+        with col1:
+            with st.expander("Surface fluxes", expanded=True):
+                st.number_input(
+                    r"$\overline{w^\prime \theta^\prime}_s$ (K m s-1)",
+                    help="potential temperature surface flux (K m s-1)",
+                    step=0.01,
+                    format="%0.2f",
+                    key="fork_wtheta"
+                )
+
+                st.number_input(
+                    r"$\overline{w^\prime q^\prime}_s$ (g kg-1 m s-1)",
+                    help="specific humidity surface flux (g kg-1 m s-1)",
+                    step=0.01,
+                    format="%0.3f",
+                    key="fork_wq"
+                )
+
+        with col2:
+            with st.expander("Mixed layer", expanded=True):
+                st.number_input(
+                    r"$\beta$ (-)",
+                    help="entrainment coefficient (-)",
+                    step=0.01,
+                    format="%0.2f",
+                    key="fork_beta"
+                )
+
+                st.number_input(
+                    r"$div$ (s-1)",
+                    help="large-scale divergence (s-1)",
+                    step=0.000001,
+                    format="%0.3e",
+                    key="fork_div"
+                )
+
 
 elif ss.main_mode == MainMode.SOUNDING:
 
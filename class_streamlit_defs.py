@@ -1,7 +1,14 @@
 from enum import Enum, auto
+from collections import OrderedDict
 import numpy as np
 import pandas as pd
 import datetime
+import hashlib
+import json
+import os
+import threading
+import time
+import uuid
 
 
 # IMPORTANT!
@@ -22,6 +29,7 @@ ep = 0.622
 class MainMode(Enum):
     PLOT = auto()
     EDIT = auto()
+    FORK = auto()
     SOUNDING = auto()
 
 
@@ -35,26 +43,74 @@ def calc_thetav_dry(theta, qt, ql):
     return thetav
 
 
+# The thermodynamic functions accept scalars as well as arrays of any shape.
 def esat_liq(t):
     Tc = t - 273.15
-    Tc = min(Tc, 50) # Avoid excess values
+    Tc = min(Tc, 50) if isinstance(Tc, float) else np.minimum(Tc, 50) # Avoid excess values
     esat = 611.21 * np.exp(17.502 * Tc / (240.97 + Tc))
     return esat
 
 
 def qsat_liq(p, t):
-    qsat = ep * esat_liq(t) / (p - (1.0 - ep) * esat_liq(t))
+    esat = esat_liq(t)
+    qsat = ep * esat / (p - (1.0 - ep) * esat)
     return qsat
 
 
 def dqsatdT_liq(p, t):
-    den = p - esat_liq(t)*(1.0 - ep)
-    dqsatdT = (ep/den + (1.0 - ep)*ep*esat_liq(t)/den**2) * Lv*esat_liq(t) / (Rv*t**2)
+    esat = esat_liq(t)
+    den = p - esat*(1.0 - ep)
+    dqsatdT = (ep/den + (1.0 - ep)*ep*esat/den**2) * Lv*esat / (Rv*t**2)
     return dqsatdT
 
 
 # Define a function to compute thetav (do saturation adjustment)
+# Arrays are adjusted at once, with a convergence mask per element. Returns thetav and ql.
 def calc_thetav(thl, qt, p, exner):
+    if np.ndim(thl) == 0 and np.ndim(qt) == 0 and np.ndim(p) == 0 and np.ndim(exner) == 0:
+        return calc_thetav_scalar(thl, qt, p, exner)
+
+    thl, qt, p, exner = [ np.asarray(values, dtype=np.float64) for values in (thl, qt, p, exner) ]
+
+    # Define the starting values of the adjustment.
+    tl = exner * thl
+    qsat = qsat_liq(p, tl)
+
+    # Unsaturated arrays need no adjustment, this is the common case in the per-level loops.
+    saturated = qt - qsat > 0.0
+    if not saturated.any():
+        return virtual_temperature(tl, qt, 0.0) / exner, np.zeros(saturated.shape)
+
+    thl, qt, p, exner, tl, qsat = np.broadcast_arrays(thl, qt, p, exner, tl, qsat)
+    qsat = qsat.copy()
+
+    # Solve the adjustment problem for the saturated elements only.
+    active = saturated.copy()
+
+    niter = 0
+    nitermax = 100
+    tnr = tl.copy()
+    tnr_old = np.full(tl.shape, 1e9)
+
+    while np.any(active) and (niter < nitermax):
+        niter += 1
+        tnr_old[active] = tnr[active]
+
+        p_a = p[active]
+        tnr_a = tnr[active]
+        qsat[active] = qsat_liq(p_a, tnr_a)
+        f = tnr_a - tl[active] - Lv/cp*(qt[active] - qsat[active])
+        f_prime = 1 + Lv/cp*dqsatdT_liq(p_a, tnr_a)
+
+        tnr[active] = tnr_a - f / f_prime
+        active[active] = np.abs(tnr[active] - tnr_old[active]) / tnr_old[active] > 1e-5
+
+    ql = np.where(saturated, qt - qsat, 0.0)
+    return virtual_temperature(tnr, qt, ql) / exner, ql
+
+
+# Scalar saturation adjustment, avoids the array overhead in the per-level loops.
+def calc_thetav_scalar(thl, qt, p, exner):
     # Define the starting values of the adjustment.
     tl = exner * thl
     qsat = qsat_liq(p, tl)
@@ -82,6 +138,415 @@ def calc_thetav(thl, qt, p, exner):
     return virtual_temperature(tnr, qt, ql) / exner, ql
 
 
+# Defaults of settings that are optional in settings files and URLs.
+optional_settings = {
+    "integrator": "euler",
+    "integrator_rtol": 1e-6,
+    "output_dtype": "float64",
+    "plume_grid": "uniform",
+    "plume_dz": 10.0,
+    "fac_ent_plume": 0.0025,
+    "beta_plume": 0.75,
+    "a_w_plume": 1.0,
+    "b_w_plume": 0.1,
+    "area_plume": 300_000.0, # 1,000 * 300 from Martin's script for Martorell.
+    "w_plume": 0.1,
+}
+
+
+# Closure parameters of the entraining plume, see integrate_entraining_plumes.
+plume_closure_settings = ["fac_ent_plume", "beta_plume", "a_w_plume", "b_w_plume", "area_plume", "w_plume"]
+
+
+# Dormand-Prince 5(4) coefficients, with the dense output polynomial of Hairer et al.
+rk45_A = np.array([
+    [0, 0, 0, 0, 0],
+    [1/5, 0, 0, 0, 0],
+    [3/40, 9/40, 0, 0, 0],
+    [44/45, -56/15, 32/9, 0, 0],
+    [19372/6561, -25360/2187, 64448/6561, -212/729, 0],
+    [9017/3168, -355/33, 46732/5247, 49/176, -5103/18656],
+])
+rk45_B = np.array([35/384, 0, 500/1113, 125/192, -2187/6784, 11/84])
+rk45_E = np.array([-71/57600, 0, 71/16695, -71/1920, 17253/339200, -22/525, 1/40])
+rk45_P = np.array([
+    [1, -8048581381/2820520608, 8663915743/2820520608, -12715105075/11282082432],
+    [0, 0, 0, 0],
+    [0, 131558114200/32700410799, -68118460800/10900136933, 87487479700/32700410799],
+    [0, -1754552775/470086768, 14199869525/1410260304, -10690763975/1880347072],
+    [0, 127303824393/49829197408, -318862633887/49829197408, 701980252875/199316789632],
+    [0, -282668133/205662961, 2019193451/616988883, -1453857185/822651844],
+    [0, 40617522/29380423, -110615467/29380423, 69997945/29380423],
+])
+
+
+# Stable hash of a settings dict, used as key for caching model output.
+# Numbers are hashed as floats, so 10 and 10.0 give the same key, dates and times in ISO format.
+def settings_hash(settings):
+    def canonical(value):
+        if isinstance(value, dict):
+            return { str(key): canonical(value[key]) for key in value }
+        if isinstance(value, (list, tuple)):
+            return [ canonical(item) for item in value ]
+        if isinstance(value, (bool, str)) or value is None:
+            return value
+        if isinstance(value, (int, float, np.number)):
+            return float(value)
+        if isinstance(value, (datetime.date, datetime.time)):
+            return value.isoformat()
+        return str(value)
+
+    settings_str = json.dumps(canonical(settings), sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(settings_str.encode("utf-8")).hexdigest()
+
+
+# Thread-safe LRU cache with a limit on the number of entries and on the total size in bytes.
+# Streamlit sessions run in threads of the same process, so a module-level instance is shared by all sessions.
+class LRUCache:
+    def __init__(self, max_entries, max_bytes, sizeof):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+
+    def get(self, key):
+        with self.lock:
+            if key not in self.entries:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return self.entries[key][0]
+
+
+    def put(self, key, value):
+        nbytes = self.sizeof(value)
+
+        with self.lock:
+            if key in self.entries:
+                self.nbytes -= self.entries.pop(key)[1]
+
+            # Items that do not fit at all are not cached.
+            if nbytes > self.max_bytes:
+                return
+
+            self.entries[key] = (value, nbytes)
+            self.nbytes += nbytes
+
+            while len(self.entries) > self.max_entries or self.nbytes > self.max_bytes:
+                _, (_, nbytes_evicted) = self.entries.popitem(last=False)
+                self.nbytes -= nbytes_evicted
+                self.evictions += 1
+
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.nbytes = 0
+
+
+    def stats(self):
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "bytes": self.nbytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+
+# Process-wide cache of model output, keyed by settings_hash. The entries hold the read-only output,
+# the final model state, and are shared between all runs with identical settings.
+run_cache = LRUCache(
+    max_entries=1024,
+    max_bytes=256 * 1024**2,
+    sizeof=lambda entry: entry[0].nbytes + entry[2].nbytes,
+)
+
+
+# Size estimate of a Plotly figure from the number of plotted points, including those of the animation frames.
+def calc_figure_size(fig):
+    traces = [ *fig.data, *(trace for frame in fig.frames for trace in frame.data) ]
+    return 8 * sum(np.size(trace.x) + np.size(trace.y) for trace in traces)
+
+
+# Process-wide cache of Plotly figures, keyed by calc_figure_key in class_streamlit.py. The entries hold the figure and
+# the notes shown with it.
+figure_cache = LRUCache(
+    max_entries=256,
+    max_bytes=64 * 1024**2,
+    sizeof=lambda entry: calc_figure_size(entry[0]),
+)
+
+
+# Process-wide memo of the environment columns, plumes and soundings of the runs, see MixedLayerModel.get_memo_key.
+# The size is that of the arrays of the memoized objects.
+memo_cache = LRUCache(
+    max_entries=4096,
+    max_bytes=128 * 1024**2,
+    sizeof=lambda value: sum(values.nbytes for values in vars(value).values() if isinstance(values, np.ndarray)),
+)
+
+
+# Numeric columns of the model output, in the units of MixedLayerModel.output.
+output_columns = ["time", "h", "theta", "dtheta", "q", "dq", "thetav", "dthetav"]
+
+
+# Variables of the model state, which are stored as snapshots at every output time, time in seconds.
+state_variables = ["time", "h", "theta", "dtheta", "q", "dq"]
+
+
+# Convert MixedLayerModel.Output to the output columns, with the moisture in g kg-1.
+def convert_output(output):
+    return {
+        "time": output.time,
+        "h": output.h,
+        "theta": output.theta,
+        "dtheta": output.dtheta,
+        "q": output.q * 1e3,
+        "dq": output.dq * 1e3,
+        "thetav": output.thetav,
+        "dthetav": output.dthetav,
+    }
+
+
+# Datetime axis of the output, computed from the start and the output time in hours.
+def calc_datetime_utc(startdate, starttime, time):
+    time = np.asarray(time, dtype=np.float64)
+    valid = np.isfinite(time)
+
+    time_us = np.zeros(time.shape, dtype=np.int64)
+    time_us[valid] = np.round(time[valid] * 3600e6)
+
+    datetime_utc = np.datetime64(datetime.datetime.combine(startdate, starttime), "us") + time_us.astype("timedelta64[us]")
+    datetime_utc[~valid] = np.datetime64("NaT")
+    return datetime_utc
+
+
+# Profiles of an entraining plume up to the level where it stops, in the units of the plots:
+# theta and thetav in K, q in g kg-1, w in m s-1, T in degC, p in hPa and z in m. The type is 1 where
+# the plume is saturated. The initial excesses dtheta_plume (K) and dq_plume (kg kg-1) identify the plume.
+# The profiles are shared through memo_cache and are read-only.
+class PlumeResult:
+    def __init__(self, dtheta_plume, dq_plume, z, theta, q, thetav, w, T, p, type, mass_flux, area, entrainment):
+        self.dtheta_plume = dtheta_plume
+        self.dq_plume = dq_plume
+        self.z = z
+        self.theta = theta
+        self.q = q
+        self.thetav = thetav
+        self.w = w
+        self.T = T
+        self.p = p
+        self.type = type
+        self.mass_flux = mass_flux
+        self.area = area
+        self.entrainment = entrainment
+
+        # The profiles are copied out of the arrays of the ensemble, so that a memoized plume does not keep those alive.
+        for key, values in list(self.__dict__.items()):
+            if isinstance(values, np.ndarray):
+                values = values.copy()
+                values.setflags(write=False)
+                setattr(self, key, values)
+
+
+# Compact struct-of-arrays output of a run. The numeric columns live in one contiguous, read-only block
+# of shape (column, time), and are available as attribute or by key, e.g. output.h or output["h"].
+# The datetime axis is available as output["time UTC"], a DataFrame view is created on demand.
+class MixedLayerOutput:
+    def __init__(self, block, time_utc):
+        self.block = block
+        self.block.flags.writeable = False
+        self.time_utc = time_utc
+        self.time_utc.flags.writeable = False
+        self.columns = { key: i for i, key in enumerate(output_columns) }
+        self.dataframe = None
+
+
+    def __getattr__(self, name):
+        columns = self.__dict__.get("columns", {})
+        if name in columns:
+            return self.block[columns[name]]
+        raise AttributeError(name)
+
+
+    def __getitem__(self, key):
+        if key == "time UTC":
+            return self.time_utc
+        return self.block[self.columns[key]]
+
+
+    def __len__(self):
+        return self.block.shape[1]
+
+
+    @property
+    def nbytes(self):
+        return self.block.nbytes + self.time_utc.nbytes
+
+
+    # DataFrame for export, the numeric columns are a view on the block.
+    def to_dataframe(self):
+        if self.dataframe is None:
+            dataframe = pd.DataFrame(self.block.T, columns=output_columns, copy=False)
+            dataframe.insert(1, "time UTC", self.time_utc)
+            self.dataframe = dataframe
+
+        return self.dataframe
+
+
+# Persistent store of model output in a local directory, keyed by settings_hash.
+# Every run is stored as a .npy file with the output columns as rows, which is memory-mapped on load
+# and returned per column and as the full array under "data",
+# and a .json file with the column names and the final model state that marks the entry as complete.
+# Files are written under a unique temporary name and renamed, so several server processes can share
+# the directory. The least recently used entries are removed once the directory exceeds max_bytes.
+# Temporary files older than tmp_max_age (s) are left over from interrupted writes and are removed.
+class RunStore:
+    def __init__(self, directory, max_bytes, tmp_max_age=3600.0):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.tmp_max_age = tmp_max_age
+        os.makedirs(self.directory, exist_ok=True)
+
+
+    def get(self, key):
+        data_path = os.path.join(self.directory, f"{key}.npy")
+        meta_path = os.path.join(self.directory, f"{key}.json")
+
+        # Entries can be removed at any time by another process, in that case they are a miss.
+        try:
+            with open(meta_path, "r") as f:
+                meta = json.load(f)
+            data = np.load(data_path, mmap_mode="r")
+        except (OSError, ValueError):
+            return None
+
+        # Marking the entry as used can fail, e.g. in a read-only store, which does not affect the data.
+        try:
+            os.utime(meta_path)
+        except OSError:
+            pass
+
+        columns = { column: data[i] for i, column in enumerate(meta["columns"]) }
+        columns["data"] = data
+        return columns, tuple(meta["state"])
+
+
+    def put(self, key, columns, state):
+        data_path = os.path.join(self.directory, f"{key}.npy")
+        meta_path = os.path.join(self.directory, f"{key}.json")
+        tmp_suffix = f".{os.getpid()}.{uuid.uuid4().hex}.tmp"
+
+        meta = {
+            "columns": list(columns.keys()),
+            "state": [ float(value) for value in state ],
+        }
+
+        try:
+            with open(data_path + tmp_suffix, "wb") as f:
+                np.save(f, np.stack(list(columns.values())).astype(np.float64))
+            os.replace(data_path + tmp_suffix, data_path)
+
+            # The metadata is written last, as its presence marks a complete entry.
+            with open(meta_path + tmp_suffix, "w") as f:
+                json.dump(meta, f)
+            os.replace(meta_path + tmp_suffix, meta_path)
+
+        except OSError:
+            for path in (data_path + tmp_suffix, meta_path + tmp_suffix):
+                if os.path.exists(path):
+                    os.remove(path)
+            return
+
+        self.evict()
+
+
+    def evict(self):
+        entries = {}
+        nbytes = 0
+        now = time.time()
+        for entry in os.scandir(self.directory):
+            key, ext = os.path.splitext(entry.name)
+            if ext not in (".npy", ".json", ".tmp"):
+                continue
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+
+            # Temporary files of writes in progress count towards the size, stale ones are removed.
+            if ext == ".tmp":
+                if now - stat.st_mtime > self.tmp_max_age:
+                    try:
+                        os.remove(entry.path)
+                    except OSError:
+                        pass
+                else:
+                    nbytes += stat.st_size
+                continue
+
+            # The last use of an entry is the latest modification of its files.
+            nbytes += stat.st_size
+            entry_info = entries.setdefault(key, [0.0, 0])
+            entry_info[0] = max(entry_info[0], stat.st_mtime)
+            entry_info[1] += stat.st_size
+
+        # Remove the least recently used entries, the metadata first so readers see a miss.
+        for key, (_, size) in sorted(entries.items(), key=lambda item: item[1][0]):
+            if nbytes <= self.max_bytes:
+                break
+
+            for ext in (".json", ".npy"):
+                try:
+                    os.remove(os.path.join(self.directory, f"{key}{ext}"))
+                except OSError:
+                    pass
+            nbytes -= size
+
+
+# Optional process-wide run store, enabled by setting the CLASS_RUN_STORE environment variable to a directory.
+# The size of the store is capped with CLASS_RUN_STORE_MAX_BYTES (default 1 GB).
+run_store = None
+if "CLASS_RUN_STORE" in os.environ:
+    run_store = RunStore(
+        os.environ["CLASS_RUN_STORE"],
+        int(os.environ.get("CLASS_RUN_STORE_MAX_BYTES", 1024**3)),
+    )
+
+
+# Mixed-layer tendencies, works on scalars as well as on arrays of runs.
+def calc_mixed_layer_tendencies(h, theta, dtheta, q, dq, wtheta, wq, beta, div, gammatheta, gammaq):
+    # First, compute the growth, assume no condensation in virtual temp calculations.
+    wthetav = wtheta * (1.0 + (Rv/Rd - 1.0) * q) + (Rv/Rd - 1.0) * theta * wq
+    thetav = calc_thetav_dry(theta, q, 0.0)
+    dthetav = calc_thetav_dry(theta + dtheta, q + dq, 0.0) - thetav
+
+    we = beta * wthetav / dthetav
+    ws = - h * div
+
+    # Compute the tendencies.
+    dhdt = we + ws
+
+    dthetadt = (wtheta + we * dtheta) / h
+    ddthetadt = we * gammatheta - dthetadt
+
+    dqdt = (wq + we * dq) / h
+    ddqdt = we * gammaq - dqdt
+
+    return dhdt, dthetadt, ddthetadt, dqdt, ddqdt
+
+
 class MixedLayerModel:
     class Output:
         pass
@@ -91,7 +556,7 @@ class MixedLayerModel:
         pass
 
 
-    def __init__(self, settings, color_index):
+    def __init__(self, settings, color_index, run=True):
         self.settings = settings
         self.color_index = color_index
 
@@ -120,26 +585,35 @@ class MixedLayerModel:
         self.dtheta_plume = settings["dtheta_plume"]
         self.dq_plume = settings["dq_plume"]
 
-        self.run()
+        # Vertical grid of the environment columns of the plumes, see calc_column_grid.
+        self.plume_grid = settings.get("plume_grid", optional_settings["plume_grid"])
+        self.plume_dz = settings.get("plume_dz", optional_settings["plume_dz"])
 
+        # Closure parameters of the plume.
+        self.plume_closure = { key: settings.get(key, optional_settings[key]) for key in plume_closure_settings }
 
-    def step(self):
-        # First, compute the growth, assume no condensation in virtual temp calculations.
-        wthetav = self.wtheta * (1.0 + (Rv/Rd - 1.0) * self.q) + (Rv/Rd - 1.0) * self.theta * self.wq
-        thetav = calc_thetav_dry(self.theta, self.q, 0.0)
-        dthetav = calc_thetav_dry(self.theta + self.dtheta, self.q + self.dq, 0.0) - thetav
+        # Optional settings, missing in older settings files and URLs.
+        self.integrator = settings.get("integrator", optional_settings["integrator"])
+        self.integrator_rtol = settings.get("integrator_rtol", optional_settings["integrator_rtol"])
+        self.output_dtype = np.dtype(settings.get("output_dtype", optional_settings["output_dtype"]))
 
-        we = self.beta * wthetav / dthetav
-        ws = - self.h * self.div
+        # Forked runs continue from the snapshot of their parent settings at fork_time (s).
+        self.fork_time = settings.get("fork_time")
+        self.fork_parent = settings.get("fork_parent")
 
-        # Compute the tendencies.
-        dhdt = we + ws
+        # Runs with identical settings share their output through the run cache and run store.
+        # Batched runs are integrated by run_mixed_layer_batch and receive their output later.
+        self.settings_hash = settings_hash({**optional_settings, **settings})
+        self.memo_hash = None
+        if run and not self.load_cached():
+            self.run()
+            self.save_cached()
 
-        dthetadt = (self.wtheta + we * self.dtheta) / self.h
-        ddthetadt = we * self.gammatheta - dthetadt
 
-        dqdt = (self.wq + we * self.dq) / self.h
-        ddqdt = we * self.gammaq - dqdt
+    def step(self):
+        dhdt, dthetadt, ddthetadt, dqdt, ddqdt = calc_mixed_layer_tendencies(
+            self.h, self.theta, self.dtheta, self.q, self.dq,
+            self.wtheta, self.wq, self.beta, self.div, self.gammatheta, self.gammaq)
 
         # Integrate the variables.
         self.time += self.dt
@@ -153,11 +627,98 @@ class MixedLayerModel:
     def run(self):
         self.time = 0
 
-        nt = round(self.runtime / self.dt)
-        nt_output = round(nt * self.dt / self.dt_output) + 1
-        nt_ratio = round(self.dt_output / self.dt)
+        output = self.allocate_output()
+        if self.fork_parent is not None:
+            self.start_from_parent(output)
+        self.integrate(output)
+        self.set_output(output)
+
+
+    # Copy the output of the parent up to the fork time and start from its snapshot there.
+    # The parent uses the time settings of this run, so normally it is found in the run cache.
+    def start_from_parent(self, output):
+        parent = MixedLayerModel({
+            **self.fork_parent,
+            "dt": self.dt,
+            "dt_output": self.dt_output,
+            "startdate": self.startdate,
+            "starttime": self.starttime,
+            }, self.color_index)
+
+        idx = min(round(self.fork_time / self.dt_output), len(parent.output.time) - 1, len(output.time) - 1)
+        shared = slice(0, idx+1)
+
+        output.time[shared] = parent.output.time[shared]
+        output.h[shared] = parent.output.h[shared]
+        output.theta[shared] = parent.output.theta[shared]
+        output.dtheta[shared] = parent.output.dtheta[shared]
+        output.q[shared] = parent.snapshots[4, shared]
+        output.dq[shared] = parent.snapshots[5, shared]
+        output.thetav[shared] = parent.output.thetav[shared]
+        output.dthetav[shared] = parent.output.dthetav[shared]
+        output.state[:, shared] = parent.snapshots[:, shared]
+
+        self.set_state(parent.snapshots[:, idx])
+
+
+    # Create a new run that shares the output of this run up to time (s), and continues from
+    # there with the changed settings, e.g. {"wtheta": 0.2}. The fork time is put on the output grid.
+    def fork(self, time, changes, color_index):
+        fork_time = round(time / self.dt_output) * self.dt_output
+        settings = { **self.settings, **changes, "fork_time": fork_time, "fork_parent": self.settings }
+        return MixedLayerModel(settings, color_index)
+
+
+    # Continue the run from its final state (the checkpoint) up to a longer runtime.
+    # Only the new tail is integrated, the existing output is kept and the tail is appended.
+    def resume(self, runtime):
+        columns_old = { key: self.output[key] for key in output_columns }
+
+        # Number of output times of the existing run that remain valid, the last output
+        # of the adaptive integrator is dropped if the old runtime was not on the output grid.
+        if self.integrator == "rk45":
+            n_keep = int(self.runtime // self.dt_output) + 1
+        else:
+            n_keep = round(self.runtime / self.dt) // round(self.dt_output / self.dt) + 1
+        n_keep = min(n_keep, len(columns_old["time"]))
+
+        self.runtime = runtime
+        self.settings = { **self.settings, "runtime": runtime }
+        self.settings_hash = settings_hash({**optional_settings, **self.settings})
+
+        if self.load_cached():
+            return
+
+        output = self.allocate_output()
+        self.integrate(output)
+
+        columns = convert_output(output)
+        for key in output_columns:
+            columns[key][:n_keep] = columns_old[key][:n_keep]
+        output.state[:, :n_keep] = self.snapshots[:, :n_keep]
+
+        self.snapshots = output.state
+        self.set_output_columns(columns)
+        self.save_cached()
+
+
+    # Check whether the settings only differ from those of this run by a longer runtime. Only Euler runs
+    # are resumed, they are identical to a fresh run. The adaptive steps of rk45 depend on the start of the
+    # integration, and a resumed run would be stored under the settings of a fresh run.
+    def can_resume(self, settings):
+        if settings["runtime"] <= self.runtime or self.integrator != "euler":
+            return False
+
+        return settings_hash({**optional_settings, **settings, "runtime": 0}) == settings_hash({**optional_settings, **self.settings, "runtime": 0})
+
+
+    def allocate_output(self):
+        if self.integrator == "rk45":
+            nt_output = round(self.runtime / self.dt_output) + 1
+        else:
+            nt = round(self.runtime / self.dt)
+            nt_output = round(nt * self.dt / self.dt_output) + 1
 
-        # Output
         output = self.Output()
         output.time = np.nan * np.zeros(nt_output)
         output.h = np.nan * np.zeros(nt_output)
@@ -167,152 +728,1113 @@ class MixedLayerModel:
         output.dq = np.nan * np.zeros(nt_output)
         output.thetav = np.nan * np.zeros(nt_output)
         output.dthetav = np.nan * np.zeros(nt_output)
+        output.state = np.nan * np.zeros((len(state_variables), nt_output))
+
+        return output
+
+
+    def write_output(self, output, ii):
+        output.time[ii] = self.time / 3600 # convert to hours.
+        output.h[ii] = self.h
+        output.theta[ii] = self.theta
+        output.dtheta[ii] = self.dtheta
+        output.q[ii] = self.q
+        output.dq[ii] = self.dq
+        output.thetav[ii] = calc_thetav_dry(self.theta, self.q, 0.0)
+        output.dthetav[ii] = calc_thetav_dry(self.theta + self.dtheta, self.q + self.dq, 0.0) - output.thetav[ii]
+        output.state[:, ii] = self.get_state()
 
-        output.time[0] = self.time
-        output.h[0] = self.h
-        output.theta[0] = self.theta
-        output.dtheta[0] = self.dtheta
-        output.q[0] = self.q
-        output.dq[0] = self.dq
-        output.thetav[0] = calc_thetav_dry(self.theta, self.q, 0.0)
-        output.dthetav[0] = calc_thetav_dry(self.theta + self.dtheta, self.q + self.dq, 0.0) - output.thetav[0]
 
-        for i in range(1, nt+1):
+    # Integrate from the current state up to the runtime, and write all output times that are passed.
+    def integrate(self, output):
+        if self.integrator == "rk45":
+            self.integrate_rk45(output)
+            return
+
+        nt_start = round(self.time / self.dt)
+        nt = round(self.runtime / self.dt)
+        nt_ratio = round(self.dt_output / self.dt)
+
+        if nt_start == 0:
+            self.write_output(output, 0)
+
+        for i in range(nt_start+1, nt+1):
             self.step()
 
             if (i % nt_ratio) == 0:
-                ii = i // nt_ratio
-                output.time[ii] = self.time / 3600 # convert to hours.
-                output.h[ii] = self.h
-                output.theta[ii] = self.theta
-                output.dtheta[ii] = self.dtheta
-                output.q[ii] = self.q
-                output.dq[ii] = self.dq
-                output.thetav[ii] = calc_thetav_dry(self.theta, self.q, 0.0)
-                output.dthetav[ii] = calc_thetav_dry(self.theta + self.dtheta, self.q + self.dq, 0.0) - output.thetav[ii]
-
-        full_datetime = datetime.datetime.combine(self.startdate, self.starttime)
-        output.datetime_utc = [ (full_datetime + datetime.timedelta(hours=time)) for time in output.time ]
-
-        self.output = pd.DataFrame(data = {
-            "time": output.time,
-            "time UTC": output.datetime_utc,
-            "h": output.h,
-            "theta": output.theta,
-            "dtheta": output.dtheta,
-            "q": output.q * 1e3,
-            "dq": output.dq * 1e3,
-            "thetav": output.thetav,
-            "dthetav": output.dthetav,
-            },
-        )
+                self.write_output(output, i // nt_ratio)
+
 
+    # Adaptive Dormand-Prince 5(4) integration with error control, the user dt is only the first step.
+    # The output is interpolated onto the dt_output grid with the 4th-order dense output of the scheme.
+    def integrate_rk45(self, output):
+        def tendencies(y):
+            return np.array(calc_mixed_layer_tendencies(
+                y[0], y[1], y[2], y[3], y[4],
+                self.wtheta, self.wq, self.beta, self.div, self.gammatheta, self.gammaq))
 
-    def launch_entraining_plume(self, time, fire_multiplier, skewt=False):
-        idx = round(time / self.dt_output)
+        # Absolute tolerances of h, theta, dtheta, q and dq.
+        atol = np.array([1e-3, 1e-5, 1e-5, 1e-9, 1e-9])
+        rtol = self.integrator_rtol
 
-        theta = self.output.theta[idx]
-        dtheta = self.output.dtheta[idx]
+        nt_output = len(output.time)
+        time_output = np.minimum(np.arange(nt_output) * self.dt_output, self.runtime)
 
-        q = self.output.q[idx] * 1e-3
-        dq = self.output.dq[idx] * 1e-3
+        t = self.time
+        y = np.array([self.h, self.theta, self.dtheta, self.q, self.dq], dtype=np.float64)
+        f = tendencies(y)
+        dt = self.dt
 
-        h = self.output.h[idx]
+        # Non-finite tendencies, e.g. without an inversion jump, cannot be integrated.
+        if not np.all(np.isfinite(f)):
+            raise FloatingPointError(f"The mixed-layer tendencies are not finite at t = {t} s")
 
-        # Create the grid.
-        dz = 10
-        z = np.arange(0, 2.0*self.output.h.values[-1] + dz/2, dz) # Extend the grid to twice the max ABL height.
+        # Rejected steps shrink the step, which may not become smaller than dt_min.
+        dt_min = 1e-6 * self.dt
 
-        # Create the environmental profiles
-        theta_env = np.where(z < h, theta, theta + dtheta + (z - h)*self.gammatheta)
-        q_env = np.where(z < h, q, q + dq + (z - h)*self.gammaq)
+        # Only the output times after the current time are written, except for a fresh start.
+        ii = np.searchsorted(time_output, t, side="right")
+        if t == 0:
+            self.write_output(output, 0)
+
+        K = np.zeros((7, 5))
+        while t < self.runtime:
+            dt = min(dt, self.runtime - t)
+
+            K[0] = f
+            for s in range(1, 6):
+                K[s] = tendencies(y + dt * (rk45_A[s, :s] @ K[:s]))
+
+            y_new = y + dt * (rk45_B @ K[:6])
+            f_new = tendencies(y_new)
+            K[6] = f_new
+
+            # Steps with non-finite stage tendencies are always rejected.
+            if np.all(np.isfinite(K)):
+                scale = atol + rtol * np.maximum(np.abs(y), np.abs(y_new))
+                error = np.sqrt(np.mean((dt * (rk45_E @ K) / scale)**2))
+            else:
+                error = np.inf
+
+            if error <= 1.0:
+                # Fill all output times within the step with the dense output.
+                Q = K.T @ rk45_P
+                while ii < nt_output and time_output[ii] <= t + dt:
+                    x = (time_output[ii] - t) / dt
+                    self.time = time_output[ii]
+                    self.h, self.theta, self.dtheta, self.q, self.dq = y + dt * (Q @ np.cumprod(np.full(4, x)))
+                    self.write_output(output, ii)
+                    ii += 1
+
+                t += dt
+                y = y_new
+                f = f_new
+
+            elif dt <= dt_min:
+                raise FloatingPointError(f"The rk45 step fell below {dt_min} s at t = {t} s")
+
+            # Standard step size control, the step shrinks where the tendencies change rapidly.
+            factor = 10.0 if error == 0.0 else 0.9 * error**(-0.2)
+            if not np.isfinite(factor):
+                factor = 0.2
+            dt *= min(10.0, max(0.2, factor))
+
+        # The model state is the final state, exactly at the end of the run.
+        self.time = t
+        self.h, self.theta, self.dtheta, self.q, self.dq = [ float(value) for value in y ]
+
+        if ii < nt_output:
+            self.write_output(output, ii)
+
+
+    def set_output(self, output):
+        self.snapshots = output.state
+        self.set_output_columns(convert_output(output))
+
+
+    # Build the output from the numeric columns, in the units of the output.
+    def set_output_columns(self, columns):
+        time_utc = calc_datetime_utc(self.startdate, self.starttime, columns["time"])
+
+        # Columns that are already a block of the right type, e.g. mapped from the run store, are not copied.
+        block = columns.get("block")
+        if block is None or block.dtype != self.output_dtype:
+            block = np.empty((len(output_columns), len(columns["time"])), dtype=self.output_dtype)
+            for i, key in enumerate(output_columns):
+                block[i] = columns[key]
+
+        self.output = MixedLayerOutput(block, time_utc)
+
+
+    # The model state, the final state of the run acts as checkpoint for resume.
+    def get_state(self):
+        return (self.time, self.h, self.theta, self.dtheta, self.q, self.dq)
+
+
+    def set_state(self, state):
+        self.time, self.h, self.theta, self.dtheta, self.q, self.dq = state
+
+
+    def get_cache_entry(self):
+        return self.output, self.get_state(), self.snapshots
+
+
+    def set_cache_entry(self, entry):
+        self.output, state, self.snapshots = entry
+        self.set_state(state)
+
+
+    # Look the output up in the run cache and the run store, returns whether it is found.
+    def load_cached(self):
+        entry = run_cache.get(self.settings_hash)
+
+        if entry is None and run_store is not None:
+            stored = run_store.get(self.settings_hash)
+            if stored is not None:
+                columns, state = stored
+                columns["block"] = columns["data"][:len(output_columns)]
+                self.set_output_columns(columns)
+                snapshots = np.stack([ columns[f"state_{key}"] for key in state_variables ])
+                entry = (self.output, state, snapshots)
+                run_cache.put(self.settings_hash, entry)
+
+        if entry is None:
+            return False
+
+        self.set_cache_entry(entry)
+        return True
+
+
+    def save_cached(self):
+        run_cache.put(self.settings_hash, self.get_cache_entry())
+
+        if run_store is not None:
+            # The time is taken from the float64 snapshots, as the output may be stored in float32,
+            # which would shift the datetime axis of the loaded run.
+            columns = { key: self.output[key] for key in output_columns }
+            columns["time"] = self.snapshots[0] / 3600
+            columns.update({ f"state_{key}": values for key, values in zip(state_variables, self.snapshots) })
+            run_store.put(self.settings_hash, columns, self.get_state())
 
-        thetav_env = np.zeros_like(z)
-        p_env = np.zeros_like(z)
-        exner_env = np.zeros_like(z)
 
-        # Compute the pressure profile.
-        p_Rdcp = np.zeros_like(z)
-        p_Rdcp[0] = p0**(Rd/cp)
-        p_env[0] = p_Rdcp[0]**(cp/Rd)
-        exner_env[0] = (p_env[0]/p0)**(Rd/cp)
+    # The diagnostic time series are memoized on the run. The memo is reset when the output
+    # of the run changes, which always goes together with a new settings hash.
+    def check_memo(self):
+        if self.memo_hash != self.settings_hash:
+            self.plume_diagnostics = {}
+            self.parcel_diagnostics = {}
+            self.memo_hash = self.settings_hash
 
-        thetav_env[0], ql = calc_thetav(theta_env[0], q_env[0], p_env[0], exner_env[0])
 
-        for i in range(1, len(z)):
-            p_Rdcp[i] = p_Rdcp[i-1] - g/cp * p0**(Rd/cp) / thetav_env[i-1] * dz
-            p_env[i] = p_Rdcp[i]**(cp/Rd)
-            exner_env[i] = (p_env[i]/p0)**(Rd/cp)
-            thetav_env[i], ql = calc_thetav(theta_env[i], q_env[i], p_env[i], exner_env[i])
-            if ql > 0:
-                print(f"Warning, environmental profile is saturated at z = {z[i]} m")
+    # Key in memo_cache of an environment column, plume or sounding of this run. The environment columns
+    # are extended in place, so they are not shared between runs with identical settings.
+    def get_memo_key(self, kind, *key):
+        return (id(self), self.settings_hash, kind, *key)
 
-        rho_env = p_env / (Rd * exner_env * thetav_env)
 
-        # Compute the entraining plume ascent.
-        theta_plume = np.zeros_like(z)
-        q_plume = np.zeros_like(z)
-        thetav_plume = np.zeros_like(z)
-        area_plume = np.zeros_like(z)
-        w_plume = np.zeros_like(z)
-        mass_flux_plume = np.zeros_like(z)
-        entrainment_plume = np.zeros_like(z)
-        detrainment_plume = np.zeros_like(z)
-        type_plume = np.zeros_like(z, dtype=np.int8)
+    # Times (s) of the output, as stored in the output. These are off the dt_output grid if dt does not divide
+    # dt_output, and output times that were never written are NaN.
+    def get_output_times(self):
+        return np.round(self.output.time.astype(np.float64) * 3600, 3)
 
-        # Initial plume conditions.
-        theta_plume[0] = theta_env[0] + fire_multiplier*self.dtheta_plume
-        q_plume[0] = q_env[0] + fire_multiplier*self.dq_plume
-        thetav_plume[0], _ = calc_thetav(theta_plume[0], q_plume[0], p_env[0], exner_env[0])
-        area_plume[0] = 300_000 # 1,000 * 300 from Martin's script for Martorell.
-        w_plume[0] = 0.1
 
-        mass_flux_plume[0] = rho_env[0] * area_plume[0] * w_plume[0]
+    # Model state at times (s), interpolated linearly between the output times. Returns a dict of h, theta,
+    # dtheta, q and dq in the units of the output, with arrays of the shape of times. At the output times the
+    # state equals the output, times outside the run give NaN.
+    def state_at(self, times):
+        times = np.asarray(times, dtype=np.float64)
+        time_output = self.get_output_times()
+        written = np.isfinite(time_output)
 
-        fac_ent = 0.0025
-        beta = 0.75
-        epsi = fac_ent*beta
-        delt = epsi/beta
+        return {
+            key: np.interp(times, time_output[written], self.output[key][written], left=np.nan, right=np.nan)
+            for key in ["h", "theta", "dtheta", "q", "dq"] }
 
-        a_w = 1.0
-        b_w = 0.1
 
-        entrainment_plume[0] = epsi*mass_flux_plume[0]
-        detrainment_plume[0] = 0.0
+    # The environment column at time (s).
+    def get_environment(self, time):
+        key = self.get_memo_key("environment", float(time))
+        env = memo_cache.get(key)
+        if env is None:
+            env = self.calc_environment(time)
+            memo_cache.put(key, env)
 
-        for i in range(1, len(z)):
-            mass_flux_plume[i] = mass_flux_plume[i-1] + (entrainment_plume[i-1] - detrainment_plume[i-1])*dz
-            theta_plume[i] = theta_plume[i-1] - entrainment_plume[i-1]*(theta_plume[i-1] - theta_env[i-1]) / mass_flux_plume[i-1] * dz
-            q_plume[i] = q_plume[i-1] - entrainment_plume[i-1]*(q_plume[i-1] - q_env[i-1]) / mass_flux_plume[i-1] * dz
+        return env
 
-            thetav_plume[i], ql = calc_thetav(theta_plume[i], q_plume[i], p_env[i], exner_env[i])
 
-            if ql > 0:
-                type_plume[i] = 1
+    def calc_environment(self, time):
+        state = self.state_at(time)
+        theta = state["theta"]
+        q = state["q"] * 1e-3
+        h = state["h"]
 
-            buoy_m = g/thetav_env[i-1] * (thetav_plume[i-1] - thetav_env[i-1])
+        # Extend the grid to twice the max ABL height, at the last output time that was written.
+        h_end = self.state_at(np.nanmax(self.get_output_times()))["h"]
+        z = calc_column_grid(h, calc_lcl_height(theta, q), 2.0*h_end, self.plume_dz, self.plume_grid)
 
-            w_plume[i] = (max(0, w_plume[i-1]**2 + 2*(a_w*buoy_m - b_w*epsi*w_plume[i-1]**2) * dz))**.5
+        return EnvironmentColumn(
+            z, h,
+            theta, state["dtheta"], self.gammatheta,
+            q, state["dq"] * 1e-3, self.gammaq)
 
-            entrainment_plume[i] = epsi * mass_flux_plume[i]
-            detrainment_plume[i] = delt * mass_flux_plume[i]
 
-            w_eps = 1e-6
-            area_plume[i] = mass_flux_plume[i] / (rho_env[i] * (w_plume[i] + w_eps))
+    # Launch a plume at time (s), the result is memoized per time and fire multiplier.
+    def launch_entraining_plume(self, time, fire_multiplier):
+        return self.launch_entraining_plumes(time, [fire_multiplier])[0]
 
-            if (area_plume[i] <= 0) or (w_plume[i] < w_eps):
+
+    # Launch plumes for a list of fire multipliers at time (s).
+    def launch_entraining_plumes(self, time, fire_multipliers):
+        return self.launch_plume_batch([ (float(time), float(fire_multiplier)) for fire_multiplier in fire_multipliers ])
+
+
+    # Launch the plumes for a list of keys (time (s), fire multiplier). The plumes that are not
+    # memoized yet are integrated together in one vectorized pass, also if their times differ.
+    def launch_plume_batch(self, keys):
+        keys = [ (float(time), float(fire_multiplier)) for time, fire_multiplier in keys ]
+        plumes = { key: memo_cache.get(self.get_memo_key("plume", *key)) for key in dict.fromkeys(keys) }
+
+        missing = [ key for key, plume in plumes.items() if plume is None ]
+        if missing:
+            times = [ key[0] for key in missing ]
+            fire_multiplier = np.array([ key[1] for key in missing ])
+
+            if len(set(times)) == 1:
+                env = self.get_environment(times[0])
+            else:
+                env = self.get_environments(times)
+
+            for key, plume in zip(missing, integrate_entraining_plumes(env, fire_multiplier*self.dtheta_plume, fire_multiplier*self.dq_plume, **self.plume_closure)):
+                plumes[key] = plume
+                memo_cache.put(self.get_memo_key("plume", *key), plume)
+
+        return [ plumes[key] for key in keys ]
+
+
+    # Time series of plume diagnostics at all output times for one fire multiplier, memoized on the run.
+    # The environment columns and plumes of all times are reduced to the diagnostics and not memoized.
+    def get_plume_diagnostics(self, fire_multiplier):
+        self.check_memo()
+
+        key = float(fire_multiplier)
+        if key not in self.plume_diagnostics:
+            # Output times that were never written have NaN diagnostics.
+            times = self.get_output_times()
+            written = np.isfinite(times)
+            env = StackedEnvironment([ self.calc_environment(time) for time in times[written] ])
+            fire_multiplier = np.full(np.count_nonzero(written), key)
+            plumes = integrate_entraining_plumes(env, fire_multiplier*self.dtheta_plume, fire_multiplier*self.dq_plume, **self.plume_closure)
+
+            diagnostics = {}
+            for variable, values in calc_plume_diagnostics(plumes).items():
+                diagnostics[variable] = np.full(len(times), np.nan)
+                diagnostics[variable][written] = values
+                diagnostics[variable].setflags(write=False)
+
+            self.plume_diagnostics[key] = diagnostics
+
+        return self.plume_diagnostics[key]
+
+
+    # Launch an ensemble of plumes at time (s) over a grid of plume settings. The axes are a dict of
+    # setting name and values, e.g. {"fac_ent_plume": [0.001, 0.0025], "area_plume": [1e5, 3e5]}, with names from
+    # plume_closure_settings, "dtheta_plume" and "dq_plume". All other settings are taken from the run, the excesses
+    # are scaled with fire_multiplier. The plumes are integrated in vectorized passes of chunk_size plumes.
+    # Returns a DataFrame with one row per combination, with the settings and the plume diagnostics.
+    def sweep_plume_settings(self, time, axes, fire_multiplier=1.0, chunk_size=1024):
+        for key in axes:
+            if key not in plume_closure_settings + ["dtheta_plume", "dq_plume"]:
+                raise KeyError(f"Setting {key} cannot be swept")
+
+        axes_values = [ np.asarray(values, dtype=np.float64) for values in axes.values() ]
+        grid = dict(zip(axes.keys(), [ values.ravel() for values in np.meshgrid(*axes_values, indexing="ij") ]))
+        n_plumes = int(np.prod([ len(values) for values in axes_values ]))
+
+        base = { "dtheta_plume": self.dtheta_plume, "dq_plume": self.dq_plume, **self.plume_closure }
+        env = self.get_environment(time)
+
+        diagnostics = []
+        for start in range(0, n_plumes, chunk_size):
+            chunk = slice(start, min(start + chunk_size, n_plumes))
+            values = { key: grid[key][chunk] if key in grid else base[key] for key in base }
+            values["dtheta_plume"] = fire_multiplier*values["dtheta_plume"]
+            values["dq_plume"] = fire_multiplier*values["dq_plume"]
+
+            diagnostics.append(calc_plume_diagnostics(integrate_entraining_plumes(env, **values)))
+
+        table = pd.DataFrame(grid)
+        for key in diagnostics[0]:
+            table[key] = np.concatenate([ chunk[key] for chunk in diagnostics ])
+
+        return table
+
+
+    # Sounding at time (s) on the grid of the skew-T plot, from the surface at p0.
+    def get_sounding(self, time):
+        key = self.get_memo_key("sounding", float(time))
+        sounding = memo_cache.get(key)
+        if sounding is None:
+            sounding = self.calc_sounding(time)
+            memo_cache.put(key, sounding)
+
+        return sounding
+
+
+    def calc_sounding(self, time):
+        state = self.state_at(time)
+
+        return calc_sounding_column(
+            state["h"],
+            state["theta"],
+            state["dtheta"],
+            self.gammatheta,
+            state["q"] * 1e-3,
+            state["dq"] * 1e-3,
+            self.gammaq,
+            p0,
+        )
+
+
+    # Parcel diagnostics at time (s) on the sounding, as a dict of parcel name and the dict of
+    # calc_parcel_diagnostics. The fire-plume parcel has the plume excesses times fire_multiplier.
+    def calc_parcels(self, time, fire_multiplier=1.0):
+        env = self.get_sounding(time)
+        theta, q = calc_parcel_start(env, fire_multiplier*self.dtheta_plume, fire_multiplier*self.dq_plume)
+        diagnostics = calc_parcel_diagnostics(env, theta, q)
+
+        return { name: { key: values[n] for key, values in diagnostics.items() } for n, name in enumerate(parcel_names) }
+
+
+    # Time series of the parcel diagnostics at all output times, as calc_parcels with arrays over time.
+    # The soundings of all times are stacked and the parcels are lifted in one vectorized pass. Only the
+    # diagnostics are memoized on the run, not the soundings.
+    def get_parcel_diagnostics(self, fire_multiplier=1.0):
+        self.check_memo()
+
+        key = float(fire_multiplier)
+        if key not in self.parcel_diagnostics:
+            # Output times that were never written have NaN diagnostics.
+            times = self.get_output_times()
+            written = np.isfinite(times)
+            env = StackedEnvironment([ self.calc_sounding(time) for time in times[written] ])
+            theta, q = calc_parcel_start(env, key*self.dtheta_plume, key*self.dq_plume)
+
+            self.parcel_diagnostics[key] = { name: {} for name in parcel_names }
+            for variable, values in calc_parcel_diagnostics(env, theta, q).items():
+                for n, name in enumerate(parcel_names):
+                    parcel_values = np.full(len(times), np.nan)
+                    parcel_values[written] = values[n]
+                    parcel_values.setflags(write=False)
+                    self.parcel_diagnostics[key][name][variable] = parcel_values
+
+        return self.parcel_diagnostics[key]
+
+
+    # The environment columns at times (s), stacked with profiles of shape (len(times), nz).
+    def get_environments(self, times):
+        return StackedEnvironment([ self.get_environment(time) for time in times ])
+
+
+    # Find the smallest fire multiplier at time (s) for which the plume saturates or, if height
+    # is given, reaches height (m) above the mixed-layer top. Returns the multiplier and the number of
+    # plume integrations, see find_critical_fire_multipliers.
+    def find_critical_fire_multiplier(self, time, height=None, bounds=(0.0, 16.0), tol=1e-3):
+        fire_multiplier, n_plumes = self.find_critical_fire_multipliers([time], height, bounds, tol)
+        return fire_multiplier[0], n_plumes
+
+
+    # Critical fire multipliers for a list of times (s), all written output times if times is None.
+    # The plumes of all times are bisected together, each round integrates one plume per unresolved time.
+    # The multiplier is found within tol, and is NaN where the criterion is not met at the upper bound.
+    # Returns the multipliers and the number of plume integrations.
+    def find_critical_fire_multipliers(self, times=None, height=None, bounds=(0.0, 16.0), tol=1e-3):
+        if times is None:
+            times = self.get_output_times()
+            times = times[np.isfinite(times)]
+
+        times = [ float(time) for time in times ]
+        h = np.array([ self.get_environment(time).h for time in times ])
+
+        def reached(rows, fire_multiplier):
+            env = self.get_environments([ times[row] for row in rows ])
+            plumes = integrate_entraining_plumes(env, fire_multiplier*self.dtheta_plume, fire_multiplier*self.dq_plume, **self.plume_closure)
+            if height is None:
+                return np.array([ np.any(plume.type > 0) for plume in plumes ])
+            else:
+                return np.array([ plume.z[-1] >= h_row + height for plume, h_row in zip(plumes, h[rows]) ])
+
+        n = len(times)
+        lo = np.full(n, float(bounds[0]))
+        hi = np.full(n, float(bounds[1]))
+
+        rows = np.arange(n)
+        reached_bounds = reached(np.concatenate([rows, rows]), np.concatenate([lo, hi]))
+        n_plumes = 2*n
+
+        fire_multiplier = np.where(reached_bounds[:n], lo, np.nan)
+        search = rows[~reached_bounds[:n] & reached_bounds[n:]]
+
+        while len(search) > 0:
+            mid = 0.5*(lo[search] + hi[search])
+            reached_mid = reached(search, mid)
+            n_plumes += len(search)
+
+            hi[search] = np.where(reached_mid, mid, hi[search])
+            lo[search] = np.where(reached_mid, lo[search], mid)
+
+            done = hi[search] - lo[search] <= tol
+            fire_multiplier[search[done]] = hi[search[done]]
+            search = search[~done]
+
+        return fire_multiplier, n_plumes
+
+
+# Vertical grid of an environment column up to z_top (m). The uniform grid has spacing dz. The adaptive grid
+# has spacing dz near the inversion at h and near the condensation level z_lcl, twice dz in the rest of the
+# mixed layer, and four times dz in the free troposphere.
+def calc_column_grid(h, z_lcl, z_top, dz, grid="uniform"):
+    if grid == "uniform":
+        return np.arange(0, z_top + dz/2, dz)
+    elif grid != "adaptive":
+        raise ValueError(f"Unknown plume grid {grid}")
+
+    z = [0.0]
+    while z[-1] < z_top:
+        if (h - 10*dz <= z[-1] <= h + 20*dz) or (abs(z[-1] - z_lcl) <= 20*dz):
+            z.append(z[-1] + dz)
+        elif z[-1] < h:
+            z.append(min(z[-1] + 2*dz, h - 10*dz))
+        else:
+            z.append(z[-1] + 4*dz)
+
+    return np.array(z)
+
+
+# Estimate of the condensation level (m) of mixed-layer air with potential temperature theta (K) and
+# specific humidity q (kg kg-1), with the dewpoint depression at the surface and 125 m K-1.
+def calc_lcl_height(theta, q):
+    e = q * p0 / (ep + (1.0 - ep) * q)
+    Td = 240.97 * np.log(e/611.21) / (17.502 - np.log(e/611.21)) + 273.15
+    return 125.0 * (theta - Td)
+
+
+# Environment column of a run at one time, or of a skew-T sounding. The grid and the theta and q profiles
+# are known from the start, the hydrostatic pressure and thetav are integrated from the surface pressure ps
+# up on demand, see extend. Saturated levels are flagged in saturated and reported by get_warnings.
+class EnvironmentColumn:
+    def __init__(self, z, h, theta, dtheta, gammatheta, q, dq, gammaq, n=64, ps=p0):
+        self.h = h
+        self.z = z
+        self.dz = np.diff(z, prepend=0.0)
+        self.nz = len(z)
+        self.n_levels = self.nz
+        self.ps = ps
+
+        # Create the environmental profiles
+        self.theta = np.where(z < h, theta, theta + dtheta + (z - h)*gammatheta)
+        self.q = np.where(z < h, q, q + dq + (z - h)*gammaq)
+
+        self.p = np.full(self.nz, np.nan)
+        self.exner = np.full(self.nz, np.nan)
+        self.thetav = np.full(self.nz, np.nan)
+        self.rho = np.full(self.nz, np.nan)
+        self.p_Rdcp = np.full(self.nz, np.nan)
+        self.saturated = np.zeros(self.nz, dtype=bool)
+
+        # Number of levels with computed profiles.
+        self.n = 0
+        self.extend(n)
+
+
+    # Compute the profiles up to level n, the rows argument is for compatibility with StackedEnvironment.
+    # Unsaturated stretches are integrated vectorized, saturated levels one by one with the saturation adjustment.
+    def extend(self, n, rows=None):
+        n = min(n, self.nz)
+        i = self.n
+
+        while i < n:
+            i = self.extend_unsaturated(i, n)
+            while i < n and self.extend_level(i):
+                i += 1
+            if i < n:
+                i += 1
+
+        ns = slice(self.n, n)
+        self.rho[ns] = self.p[ns] / (Rd * self.exner[ns] * self.thetav[ns])
+        self.n = max(self.n, n)
+
+
+    # Integrate the levels from i up to n as if they are unsaturated, the pressure depends on the thetav of the
+    # level below, so the profiles are iterated to a fixed point, starting from the dry thetav. The levels below
+    # the first saturated level are kept, the index of that level is returned.
+    def extend_unsaturated(self, i, n):
+        if i == 0:
+            return 0
+
+        ns = slice(i, n)
+        thetav = np.empty(n - i + 1)
+        thetav[0] = self.thetav[i-1]
+        thetav[1:] = virtual_temperature(self.theta[ns], self.q[ns], 0.0)
+
+        for _ in range(4):
+            p_Rdcp = np.subtract.accumulate(np.concatenate(([self.p_Rdcp[i-1]], g/cp * p0**(Rd/cp) / thetav[:-1] * self.dz[ns])))[1:]
+            p = p_Rdcp**(cp/Rd)
+            exner = (p/p0)**(Rd/cp)
+            thetav_new, ql = calc_thetav(self.theta[ns], self.q[ns], p, exner)
+
+            n_valid = np.argmax(ql > 0) if np.any(ql > 0) else n - i
+            converged = np.array_equal(thetav_new[:n_valid], thetav[1:n_valid+1])
+            thetav[1:] = thetav_new
+            if converged:
                 break
 
-        if skewt:
-            return exner_env[:i] * theta_plume[:i] - 273.15, type_plume[:i], p_env[:i] / 100.0
+        valid = slice(i, i + n_valid)
+        self.p_Rdcp[valid] = p_Rdcp[:n_valid]
+        self.p[valid] = p[:n_valid]
+        self.exner[valid] = exner[:n_valid]
+        self.thetav[valid] = thetav_new[:n_valid]
+
+        return i + n_valid
+
+
+    # Integrate level i with the saturation adjustment, returns whether the level is saturated.
+    def extend_level(self, i):
+        if i == 0:
+            self.p_Rdcp[0] = self.ps**(Rd/cp)
         else:
-            return theta_plume[:i], q_plume[:i] * 1e3, thetav_plume[:i], type_plume[:i], z[:i], w_plume[:i]
+            self.p_Rdcp[i] = self.p_Rdcp[i-1] - g/cp * p0**(Rd/cp) / self.thetav[i-1] * self.dz[i]
+
+        self.p[i] = self.p_Rdcp[i]**(cp/Rd)
+        self.exner[i] = (self.p[i]/p0)**(Rd/cp)
+        self.thetav[i], ql = calc_thetav(self.theta[i], self.q[i], self.p[i], self.exner[i])
+        self.saturated[i] = ql > 0
+
+        return self.saturated[i]
+
+
+    # Warnings about the computed part of the column, as a list of messages.
+    def get_warnings(self):
+        z_saturated = self.z[:self.n][self.saturated[:self.n]]
+        if len(z_saturated) == 0:
+            return []
+
+        return [ f"Environmental profile is saturated at {len(z_saturated)} levels between z = {z_saturated[0]:.0f} and {z_saturated[-1]:.0f} m" ]
+
+
+# Environment columns stacked with one column per row, the profiles have shape (ncolumn, nz) where nz is that
+# of the highest column. Shorter columns are padded with NaN and end at their own n_levels.
+class StackedEnvironment:
+    def __init__(self, columns):
+        self.columns = columns
+        self.h = np.array([ column.h for column in columns ])
+        self.nz = max(column.nz for column in columns)
+        self.n_levels = np.array([ column.nz for column in columns ])
+
+        for key in ("z", "dz", "theta", "q", "p", "exner", "thetav", "rho"):
+            setattr(self, key, np.full((len(columns), self.nz), np.nan))
+
+        for row, column in enumerate(columns):
+            for key in ("z", "dz", "theta", "q"):
+                getattr(self, key)[row, :column.nz] = getattr(column, key)
+
+        self.n = 0
+        self.extend(min(column.n for column in columns))
+
+
+    # Compute the profiles up to level n, for the given rows only if rows is not None.
+    def extend(self, n, rows=None):
+        n = min(n, self.nz)
+
+        for row in range(len(self.columns)) if rows is None else np.unique(rows):
+            column = self.columns[row]
+            column.extend(n)
+            ns = slice(self.n, min(n, column.nz))
+            for key in ("p", "exner", "thetav", "rho"):
+                getattr(self, key)[row, ns] = getattr(column, key)[ns]
+
+        self.n = max(self.n, n)
+
+
+# Integrate an ensemble of entraining plumes through the environment in one pass over the levels.
+# The initial excesses dtheta_plume (K) and dq_plume (kg kg-1) have one value per plume. The environment is
+# either an EnvironmentColumn shared by all plumes, or a StackedEnvironment with one column per plume. Each plume
+# stops independently once its vertical velocity or area collapses or it reaches the top of its column,
+# only the active plumes are advanced. The environment is extended upward only as far as the plumes rise.
+# The arithmetic per plume is that of a single plume, so the result does not depend on the ensemble.
+# The closure parameters, named as in plume_closure_settings, are scalars or arrays with one value per plume.
+def integrate_entraining_plumes(
+        env, dtheta_plume, dq_plume,
+        fac_ent_plume=optional_settings["fac_ent_plume"],
+        beta_plume=optional_settings["beta_plume"],
+        a_w_plume=optional_settings["a_w_plume"],
+        b_w_plume=optional_settings["b_w_plume"],
+        area_plume=optional_settings["area_plume"],
+        w_plume=optional_settings["w_plume"]):
+    dtheta_plume, dq_plume, fac_ent, beta, a_w, b_w, area_start, w_start = np.broadcast_arrays(
+        *[ np.atleast_1d(np.asarray(values, dtype=np.float64))
+           for values in (dtheta_plume, dq_plume, fac_ent_plume, beta_plume, a_w_plume, b_w_plume, area_plume, w_plume) ])
+
+    nplume = dtheta_plume.size
+    nz = env.nz
+
+    theta_plume = np.zeros((nplume, nz))
+    q_plume = np.zeros((nplume, nz))
+    thetav_plume = np.zeros((nplume, nz))
+    area_plume = np.zeros((nplume, nz))
+    w_plume = np.zeros((nplume, nz))
+    mass_flux_plume = np.zeros((nplume, nz))
+    entrainment_plume = np.zeros((nplume, nz))
+    type_plume = np.zeros((nplume, nz), dtype=np.int8)
+
+    # Number of valid levels per plume, plumes that reach the top of their column keep all levels but the top one.
+    n_levels = np.zeros(nplume, dtype=int)
+
+    # The environment at level i of the plumes a, for shared and per-plume profiles.
+    def env_level(values, a, i):
+        return values[a, i] if np.ndim(values) == 2 else values[i]
+
+    def env_top(a):
+        return env.n_levels[a] if np.ndim(env.n_levels) == 1 else env.n_levels
+
+    a = np.arange(nplume)
+
+    # Initial plume conditions.
+    theta_plume[:, 0] = env_level(env.theta, a, 0) + dtheta_plume
+    q_plume[:, 0] = env_level(env.q, a, 0) + dq_plume
+    thetav_plume[:, 0], _ = calc_thetav(theta_plume[:, 0], q_plume[:, 0], env_level(env.p, a, 0), env_level(env.exner, a, 0))
+    area_plume[:, 0] = area_start
+    w_plume[:, 0] = w_start
+
+    mass_flux_plume[:, 0] = env_level(env.rho, a, 0) * area_plume[:, 0] * w_plume[:, 0]
+
+    epsi = fac_ent*beta
+    delt = epsi/beta
+
+    entrainment_plume[:, 0] = epsi*mass_flux_plume[:, 0]
+
+    w_eps = 1e-6
+
+    # The state of the active plumes at the previous level.
+    mass_flux = mass_flux_plume[:, 0]
+    theta = theta_plume[:, 0]
+    q = q_plume[:, 0]
+    thetav = thetav_plume[:, 0]
+    w = w_plume[:, 0]
+    entrainment = entrainment_plume[:, 0]
+    detrainment = np.zeros(nplume)
+
+    # The closure parameters of the active plumes.
+    epsi_a, delt_a, a_w_a, b_w_a = epsi, delt, a_w, b_w
+
+    for i in range(1, nz):
+        if i >= env.n:
+            env.extend(env.n + 64, a)
+
+        dz = env_level(env.dz, a, i)
+        theta_env = env_level(env.theta, a, i-1)
+        q_env = env_level(env.q, a, i-1)
+        thetav_env = env_level(env.thetav, a, i-1)
+
+        mass_flux_new = mass_flux + (entrainment - detrainment)*dz
+        theta_new = theta - entrainment*(theta - theta_env) / mass_flux * dz
+        q_new = q - entrainment*(q - q_env) / mass_flux * dz
+
+        thetav_new, ql = calc_thetav(theta_new, q_new, env_level(env.p, a, i), env_level(env.exner, a, i))
+
+        buoy_m = g/thetav_env * (thetav - thetav_env)
+
+        w_new = (np.maximum(0, w**2 + 2*(a_w_a*buoy_m - b_w_a*epsi_a*w**2) * dz))**.5
+
+        entrainment = epsi_a * mass_flux_new
+        detrainment = delt_a * mass_flux_new
+
+        area = mass_flux_new / (env_level(env.rho, a, i) * (w_new + w_eps))
+
+        mass_flux, theta, q, thetav, w = mass_flux_new, theta_new, q_new, thetav_new, w_new
+
+        mass_flux_plume[a, i] = mass_flux
+        theta_plume[a, i] = theta
+        q_plume[a, i] = q
+        thetav_plume[a, i] = thetav
+        type_plume[a, i] = ql > 0
+        w_plume[a, i] = w
+        entrainment_plume[a, i] = entrainment
+        area_plume[a, i] = area
+
+        stop = (area <= 0) | (w < w_eps) | (i >= env_top(a) - 1)
+        if stop.any():
+            n_levels[a[stop]] = i
+            keep = ~stop
+            a = a[keep]
+            if len(a) == 0:
+                break
+
+            mass_flux, theta, q, thetav, w, entrainment, detrainment, epsi_a, delt_a, a_w_a, b_w_a = [
+                values[keep] for values in (mass_flux, theta, q, thetav, w, entrainment, detrainment, epsi_a, delt_a, a_w_a, b_w_a) ]
+
+    plumes = []
+    for n in range(nplume):
+        ns = slice(0, n_levels[n])
+        exner_env = env.exner[n, ns] if env.exner.ndim == 2 else env.exner[ns]
+        p_env = env.p[n, ns] if env.p.ndim == 2 else env.p[ns]
+        z = env.z[n, ns] if env.z.ndim == 2 else env.z[ns]
+
+        plumes.append(PlumeResult(
+            dtheta_plume[n],
+            dq_plume[n],
+            z,
+            theta_plume[n, ns],
+            q_plume[n, ns] * 1e3,
+            thetav_plume[n, ns],
+            w_plume[n, ns],
+            exner_env * theta_plume[n, ns] - 273.15,
+            p_env / 100.0,
+            type_plume[n, ns],
+            mass_flux_plume[n, ns],
+            area_plume[n, ns],
+            entrainment_plume[n, ns],
+            ))
+
+    return plumes
+
+
+# Names of the parcels of MixedLayerModel.calc_parcels, and the parcel diagnostics of calc_parcel_diagnostics.
+parcel_names = ["surface-based", "mixed-layer", "fire plume"]
+parcel_variables = ["LCL", "LFC", "EL", "CAPE", "CIN"]
+
+
+# Undiluted parcels lifted from the surface through the environment env, with profiles of shape (nz) or
+# (ncolumn, nz) that are computed up to the top. The parcels start with potential temperature theta (K) and
+# specific humidity q (kg kg-1), arrays of shape (...) for a single column or (..., ncolumn), and conserve their
+# liquid-water potential temperature and total water. Returns a dict with the heights (m) of the LCL, LFC and EL,
+# their pressures (hPa) as "p LCL", "p LFC" and "p EL", and the CAPE and CIN (J kg-1). The CAPE is the positive
+# buoyancy between the LFC and EL, the EL is the highest buoyant level within the column. Parcels without an LFC
+# have NaN levels and CIN, and zero CAPE.
+def calc_parcel_diagnostics(env, theta, q):
+    theta = np.asarray(theta, dtype=np.float64)[..., None]
+    q = np.asarray(q, dtype=np.float64)[..., None]
+
+    thetav_parcel, ql = calc_thetav(theta, q, env.p, env.exner)
+    buoyancy = g * (thetav_parcel - env.thetav) / env.thetav
+    level = np.arange(env.nz)
+
+    saturated = ql > 0
+    has_lcl = saturated.any(axis=-1)
+    i_lcl = np.argmax(saturated, axis=-1)
+
+    positive = (buoyancy > 0) & (level >= i_lcl[..., None]) & has_lcl[..., None]
+    has_lfc = positive.any(axis=-1)
+    i_lfc = np.argmax(positive, axis=-1)
+    i_el = env.nz - 1 - np.argmax(positive[..., ::-1], axis=-1)
+
+    dz = np.broadcast_to(env.dz, buoyancy.shape)
+    between = (level >= i_lfc[..., None]) & (level <= i_el[..., None]) & (buoyancy > 0)
+    below = (level < i_lfc[..., None]) & (buoyancy < 0)
+    cape = np.where(has_lfc, np.sum(np.where(between, buoyancy*dz, 0.0), axis=-1), 0.0)
+    cin = np.where(has_lfc, np.sum(np.where(below, buoyancy*dz, 0.0), axis=-1), np.nan)
+
+    def at_level(values, i, valid):
+        values = np.take_along_axis(np.broadcast_to(values, buoyancy.shape), i[..., None], axis=-1)[..., 0]
+        return np.where(valid, values, np.nan)
+
+    return {
+        "LCL": at_level(env.z, i_lcl, has_lcl),
+        "LFC": at_level(env.z, i_lfc, has_lfc),
+        "EL": at_level(env.z, i_el, has_lfc),
+        "CAPE": cape,
+        "CIN": cin,
+        "p LCL": at_level(env.p, i_lcl, has_lcl) / 100.0,
+        "p LFC": at_level(env.p, i_lfc, has_lfc) / 100.0,
+        "p EL": at_level(env.p, i_el, has_lfc) / 100.0,
+    }
+
+
+# Start values of the parcels of parcel_names in env, as arrays of shape (parcel) or (parcel, ncolumn). The
+# mixed-layer parcel is the mean over the lowest 100 hPa, the fire-plume parcel has the excesses of the plume.
+def calc_parcel_start(env, dtheta_plume, dq_plume):
+    theta_surface = env.theta[..., 0]
+    q_surface = env.q[..., 0]
+
+    layer = env.p >= env.p[..., :1] - 1e4
+    theta_layer = np.sum(np.where(layer, env.theta, 0.0), axis=-1) / np.sum(layer, axis=-1)
+    q_layer = np.sum(np.where(layer, env.q, 0.0), axis=-1) / np.sum(layer, axis=-1)
+
+    theta = np.stack([theta_surface, theta_layer, theta_surface + dtheta_plume])
+    q = np.stack([q_surface, q_layer, q_surface + dq_plume])
+
+    return theta, q
+
+
+# Diagnostics of a list of plumes, as arrays with one value per plume. The plume top and condensation
+# level are in m, the condensation level is NaN for dry plumes. PyroCu is 1 for plumes that saturate.
+def calc_plume_diagnostics(plumes):
+    return {
+        "plume top": np.array([ plume.z[-1] for plume in plumes ]),
+        "plume condensation level": np.array([ plume.z[np.argmax(plume.type > 0)] if np.any(plume.type > 0) else np.nan for plume in plumes ]),
+        "plume max w": np.array([ np.max(plume.w) for plume in plumes ]),
+        "pyroCu": np.array([ float(np.any(plume.type > 0)) for plume in plumes ]),
+    }
+
+
+# Integrate arrays of runs that share dt and dt_output, the state is advanced for all runs together.
+# The arithmetic is identical to MixedLayerModel.step(), so the output matches MixedLayerModel.run().
+# Runs with fewer time steps nt are frozen with a zero time step once they are finished.
+def integrate_mixed_layer_arrays(h, theta, dtheta, q, dq, wtheta, wq, beta, div, gammatheta, gammaq, dt, dt_output, nt):
+    h, theta, dtheta, q, dq = [ np.array(values, dtype=np.float64) for values in (h, theta, dtheta, q, dq) ]
+    nt = np.broadcast_to(nt, h.shape)
+    nt_output = np.round(nt * dt / dt_output).astype(int) + 1
+    nt_ratio = round(dt_output / dt)
+
+    # Output, stored as (time, run).
+    shape = (nt_output.max(), len(h))
+    output = MixedLayerModel.Output()
+    output.time = np.nan * np.zeros(shape)
+    output.h = np.nan * np.zeros(shape)
+    output.theta = np.nan * np.zeros(shape)
+    output.dtheta = np.nan * np.zeros(shape)
+    output.q = np.nan * np.zeros(shape)
+    output.dq = np.nan * np.zeros(shape)
+    time_state = np.nan * np.zeros(shape)
+
+    time = 0
+    run_time = np.zeros(len(h))
+    output.time[0, :] = time
+    time_state[0, :] = time
+    output.h[0, :] = h
+    output.theta[0, :] = theta
+    output.dtheta[0, :] = dtheta
+    output.q[0, :] = q
+    output.dq[0, :] = dq
+
+    for i in range(1, nt.max()+1):
+        dhdt, dthetadt, ddthetadt, dqdt, ddqdt = calc_mixed_layer_tendencies(
+            h, theta, dtheta, q, dq, wtheta, wq, beta, div, gammatheta, gammaq)
+
+        # Finished runs get a zero time step, so their state stays at the final value.
+        dt_active = np.where(i <= nt, dt, 0.0)
+
+        time += dt
+        run_time += dt_active
+        h += dt_active * dhdt
+        theta += dt_active * dthetadt
+        dtheta += dt_active * ddthetadt
+        q += dt_active * dqdt
+        dq += dt_active * ddqdt
+
+        if (i % nt_ratio) == 0:
+            ii = i // nt_ratio
+            if ii < shape[0]:
+                output.time[ii, :] = time / 3600 # convert to hours.
+                time_state[ii, :] = time
+                output.h[ii, :] = h
+                output.theta[ii, :] = theta
+                output.dtheta[ii, :] = dtheta
+                output.q[ii, :] = q
+                output.dq[ii, :] = dq
+
+    # Runs that finished early do not pass the last output times, mark them as missing.
+    ii = np.arange(shape[0])[:, None]
+    missing = ii > nt // nt_ratio
+    for values in (output.time, time_state, output.h, output.theta, output.dtheta, output.q, output.dq):
+        values[missing] = np.nan
+
+    output.thetav = calc_thetav_dry(output.theta, output.q, 0.0)
+    output.dthetav = calc_thetav_dry(output.theta + output.dtheta, output.q + output.dq, 0.0) - output.thetav
+    output.state = np.stack([time_state, output.h, output.theta, output.dtheta, output.q, output.dq])
+
+    return output, nt_output, (run_time, h, theta, dtheta, q, dq)
+
+
+# Integrate many runs at once, runs with different time settings are grouped.
+def run_mixed_layer_batch(settings_list, color_indices):
+    runs = [ MixedLayerModel(settings, color_index, run=False) for settings, color_index in zip(settings_list, color_indices) ]
+
+    # Runs found in the run cache or store are not integrated, and runs with identical settings only once.
+    to_run = {}
+    for run in runs:
+        if not run.load_cached():
+            to_run.setdefault(run.settings_hash, run)
+
+    # Runs that share the time step and output interval are integrated in one loop.
+    groups = {}
+    # The adaptive integrator has its own time steps per run, and forked runs start from their parent,
+    # so these runs are integrated one by one.
+    for run in to_run.values():
+        if run.integrator == "euler" and run.fork_parent is None:
+            groups.setdefault((run.dt, run.dt_output), []).append(run)
+        else:
+            run.run()
+            run.save_cached()
+
+    for (dt, dt_output), group in groups.items():
+        output, nt_output, final_state = integrate_mixed_layer_arrays(
+            [ run.h for run in group ],
+            [ run.theta for run in group ],
+            [ run.dtheta for run in group ],
+            [ run.q for run in group ],
+            [ run.dq for run in group ],
+            np.array([ run.wtheta for run in group ]),
+            np.array([ run.wq for run in group ]),
+            np.array([ run.beta for run in group ]),
+            np.array([ run.div for run in group ]),
+            np.array([ run.gammatheta for run in group ]),
+            np.array([ run.gammaq for run in group ]),
+            dt,
+            dt_output,
+            np.array([ round(run.runtime / dt) for run in group ]),
+        )
+
+        for n, run in enumerate(group):
+            run.time, run.h, run.theta, run.dtheta, run.q, run.dq = [ values[n] for values in final_state ]
+
+            # Runs are only valid up to their own number of output times.
+            run_output = MixedLayerModel.Output()
+            ns = slice(0, nt_output[n])
+            run_output.time = output.time[ns, n]
+            run_output.h = output.h[ns, n]
+            run_output.theta = output.theta[ns, n]
+            run_output.dtheta = output.dtheta[ns, n]
+            run_output.q = output.q[ns, n]
+            run_output.dq = output.dq[ns, n]
+            run_output.thetav = output.thetav[ns, n]
+            run_output.dthetav = output.dthetav[ns, n]
+            run_output.state = output.state[:, ns, n]
+
+            run.set_output(run_output)
+            run.save_cached()
+
+    for run in runs:
+        if not hasattr(run, "output"):
+            run.set_cache_entry(to_run[run.settings_hash].get_cache_entry())
+
+    return runs
+
+
+# Variables in the result cube of sweep_mixed_layer, in the units of MixedLayerModel.output.
+sweep_variables = ["h", "theta", "dtheta", "q", "dq", "thetav", "dthetav"]
+
+
+# Run a grid of settings in one vectorized pass. The axes are a dict of setting name and values, e.g.
+# {"beta": [0.1, 0.2], "wtheta": [0.05, 0.1, 0.2]}, all other settings are taken from base_settings.
+# Returns the cube indexed as (axes..., time, variable), the output time in hours and the variable names.
+# If filename is given, the cube is written to a memory-mapped .npy file in chunks of chunk_size runs.
+# The sweep always uses the forward Euler scheme of MixedLayerModel.step() with the dt of base_settings.
+def sweep_mixed_layer(base_settings, axes, filename=None, chunk_size=4096):
+    state_keys = ["h", "theta", "dtheta", "q", "dq"]
+    param_keys = ["wtheta", "wq", "beta", "div", "gammatheta", "gammaq"]
+
+    for key in axes:
+        if key not in state_keys + param_keys:
+            raise KeyError(f"Setting {key} cannot be swept")
+
+    axes_values = [ np.asarray(values, dtype=np.float64) for values in axes.values() ]
+    axes_shape = tuple(len(values) for values in axes_values)
+    grid = dict(zip(axes.keys(), [ values.ravel() for values in np.meshgrid(*axes_values, indexing="ij") ]))
+    n_runs = int(np.prod(axes_shape))
+
+    dt = base_settings["dt"]
+    dt_output = base_settings["dt_output"]
+    nt = round(base_settings["runtime"] / dt)
+    nt_output = round(nt * dt / dt_output) + 1
+
+    shape = axes_shape + (nt_output, len(sweep_variables))
+    if filename is None:
+        cube = np.empty(shape)
+    else:
+        cube = np.lib.format.open_memmap(filename, mode="w+", dtype=np.float64, shape=shape)
+
+    cube_flat = cube.reshape((n_runs, nt_output, len(sweep_variables)))
+
+    for start in range(0, n_runs, chunk_size):
+        chunk = slice(start, min(start + chunk_size, n_runs))
+        values = { key: grid[key][chunk] if key in grid else np.full(chunk.stop - chunk.start, base_settings[key], dtype=np.float64)
+                   for key in state_keys + param_keys }
+
+        output, _, _ = integrate_mixed_layer_arrays(
+            *[ values[key] for key in state_keys + param_keys ], dt, dt_output, nt)
+
+        # Convert the moisture to g kg-1, as in MixedLayerModel.output.
+        output.q *= 1e3
+        output.dq *= 1e3
+
+        for j, variable in enumerate(sweep_variables):
+            cube_flat[chunk, :, j] = getattr(output, variable).T
+
+    if filename is not None:
+        cube.flush()
+
+    return cube, output.time[:, 0], sweep_variables
+
+
+# Largest-triangle-three-buckets downsampling of line series to n_out points, which keeps the peaks and the shape
+# of the lines. xs and ys are lists of 1D arrays, x increasing, with series of different lengths. The interior of each
+# series is divided into n_out-2 buckets, and in each bucket the point that forms the largest triangle with the
+# previously kept point and the mean of the next bucket is kept. The buckets are processed for all series together.
+# Returns the indices of the kept points per series, series with at most n_out points are kept whole.
+def calc_lttb_indices(xs, ys, n_out):
+    indices = [ np.arange(len(x)) for x in xs ]
+    rows = [ row for row, x in enumerate(xs) if len(x) > n_out ]
+    if not rows or n_out < 3:
+        return indices
+
+    n = np.array([ len(xs[row]) for row in rows ])
+    n_max = n.max()
+    x = np.full((len(rows), n_max + 1), np.nan)
+    y = np.full((len(rows), n_max + 1), np.nan)
+    for k, row in enumerate(rows):
+        x[k, :n[k]] = xs[row]
+        y[k, :n[k]] = ys[row]
+
+    # Cumulative sums for the bucket means, missing values are left out.
+    finite = np.isfinite(x) & np.isfinite(y)
+    zeros = np.zeros((len(rows), 1))
+    x_sum = np.hstack([zeros, np.cumsum(np.where(finite, x, 0.0), axis=1)])
+    y_sum = np.hstack([zeros, np.cumsum(np.where(finite, y, 0.0), axis=1)])
+    n_sum = np.hstack([zeros, np.cumsum(finite, axis=1)])
+
+    # Bucket edges, the last two buckets hold the last point and the padding.
+    edges = 1 + np.arange(n_out - 1)[None, :] * (n[:, None] - 2) // (n_out - 2)
+    edges = np.hstack([edges, n[:, None]])
+
+    kept = np.zeros((len(rows), n_out), dtype=int)
+    kept[:, -1] = n - 1
+    a = np.zeros(len(rows), dtype=int)
+    all_rows = np.arange(len(rows))
+
+    for bucket in range(n_out - 2):
+        lo, hi, hi_next = edges[:, bucket], edges[:, bucket+1], edges[:, bucket+2]
+
+        count = n_sum[all_rows, hi_next] - n_sum[all_rows, hi]
+        with np.errstate(invalid="ignore", divide="ignore"):
+            x_next = (x_sum[all_rows, hi_next] - x_sum[all_rows, hi]) / count
+            y_next = (y_sum[all_rows, hi_next] - y_sum[all_rows, hi]) / count
+
+        width = hi - lo
+        candidates = np.minimum(lo[:, None] + np.arange(width.max())[None, :], n_max)
+        x_a, y_a = x[all_rows, a][:, None], y[all_rows, a][:, None]
+
+        area = np.abs((x_a - x_next[:, None]) * (y[all_rows[:, None], candidates] - y_a)
+                      - (x_a - x[all_rows[:, None], candidates]) * (y_next[:, None] - y_a))
+        area = np.where((np.arange(width.max())[None, :] < width[:, None]) & np.isfinite(area), area, -1.0)
+
+        a = candidates[all_rows, np.argmax(area, axis=1)]
+        kept[:, bucket+1] = a
+
+    for k, row in enumerate(rows):
+        indices[row] = kept[k]
+
+    return indices
+
+
+# Line plot variables that come from MixedLayerModel.get_plume_diagnostics and get_parcel_diagnostics.
+plume_diagnostic_variables = ["plume top", "plume condensation level", "plume max w", "pyroCu"]
+parcel_diagnostic_variables = ["parcel LCL", "parcel LFC", "parcel EL", "parcel CAPE", "parcel CIN"]
 
 
 class LinePlot:
     def __init__(self):
         self.xaxis_options = ["time", "time UTC"]
-        self.yaxis_options = ["h", "theta", "dtheta", "q", "dq", "thetav", "dthetav"]
+        self.yaxis_options = ["h", "theta", "dtheta", "q", "dq", "thetav", "dthetav"] + plume_diagnostic_variables + parcel_diagnostic_variables
         self.xaxis_index = 0
         self.yaxis_index = 0
         self.xaxis_key = self.xaxis_options[0]
@@ -353,38 +1875,90 @@ def skew_transform(temp_c, pressure_hpa):
     return skewed_temp
 
 
-def calc_skew_lines(h, theta, dtheta, gammatheta, q, dq, gammaq, p0):
-    # Create the grid.
-    dz = 10
-    z_max = 5_000
+# Merge lines of shape (nline, npoint) into one line with NaN separators, for a single Plotly trace.
+def merge_lines(x, y):
+    nan = np.full((x.shape[0], 1), np.nan)
+    return np.hstack([x, nan]).ravel(), np.hstack([y, nan]).ravel()
+
+
+# Background lines of the skew-T plot as a dict of name and merged (x, y), with x the skewed temperature (degC)
+# and y the pressure (hPa). Points outside the temperature range of the plot are NaN. Use get_skew_background.
+def calc_skew_background():
+    background = {}
+
+    # Isotherms (constant temperature lines).
+    p_levels = np.array([1000, 850, 700, 500, 400, 300, 250, 200, 100])
+    temp_range = np.arange(-90, 51, 10)
+    temp, p = np.meshgrid(temp_range, p_levels, indexing="ij")
+    background["isotherms"] = merge_lines(skew_transform(temp, p), p.astype(np.float64))
 
-    z = np.arange(0, z_max + dz/2, dz) # Extend the grid to twice the max ABL height.
+    # Dry adiabats (constant potential temperature), θ = T * (1000/P)^0.286
+    theta_levels = np.arange(200, 500, 20)
+    p = np.logspace(2, 3, 50)[None, :]
+    temp = theta_levels[:, None] * (p/1000)**0.286 - 273.15
+    temp = np.where((temp >= -90) & (temp <= 50), temp, np.nan)
+    background["dry adiabats"] = merge_lines(skew_transform(temp, p), np.broadcast_to(p, temp.shape))
 
-    # Create the environmental profiles
-    theta_env = np.where(z < h, theta, theta + dtheta + (z - h)*gammatheta)
-    q_env = np.where(z < h, q, q + dq + (z - h)*gammaq)
+    # Moist (pseudo-)adiabats, integrated upward from 1050 hPa with a midpoint scheme, all lines at once.
+    def dTdp(T, p):
+        esat = esat_liq(T)
+        rsat = ep * esat / (p - esat)
+        return (Rd*T + Lv*rsat) / (p * (cp + Lv**2 * rsat * ep / (Rd * T**2)))
 
-    thetav_env = np.zeros_like(z)
-    p_env = np.zeros_like(z)
-    exner_env = np.zeros_like(z)
+    p = np.logspace(np.log10(1050e2), np.log10(200e2), 80)
+    temp = np.empty((12, len(p)))
+    temp[:, 0] = np.arange(-15, 45, 5) + 273.15
+    for i in range(1, len(p)):
+        dp = p[i] - p[i-1]
+        T_mid = temp[:, i-1] + 0.5*dp*dTdp(temp[:, i-1], p[i-1])
+        temp[:, i] = temp[:, i-1] + dp*dTdp(T_mid, p[i-1] + 0.5*dp)
+    temp -= 273.15
+    temp = np.where(temp >= -90, temp, np.nan)
+    p = np.broadcast_to(p / 100, temp.shape)
+    background["moist adiabats"] = merge_lines(skew_transform(temp, p), p)
 
-    # Compute the pressure profile.
-    p_Rdcp = np.zeros_like(z)
-    p_Rdcp[0] = p0**(Rd/cp)
-    p_env[0] = p_Rdcp[0]**(cp/Rd)
-    exner_env[0] = (p_env[0]/p0)**(Rd/cp)
+    # Saturation mixing-ratio lines (g kg-1), from the inverse of the saturation vapor pressure.
+    r = np.array([0.4, 1, 2, 3, 5, 8, 12, 16, 20])[:, None] * 1e-3
+    p = np.linspace(1050e2, 600e2, 10)[None, :]
+    log_e = np.log(r * p / (ep + r) / 611.21)
+    temp = 240.97 * log_e / (17.502 - log_e)
+    p = np.broadcast_to(p / 100, temp.shape)
+    background["mixing-ratio lines"] = merge_lines(skew_transform(temp, p), p)
 
-    thetav_env[0], ql = calc_thetav(theta_env[0], q_env[0], p_env[0], exner_env[0])
+    return background
 
-    for i in range(1, len(z)):
-        p_Rdcp[i] = p_Rdcp[i-1] - g/cp * p0**(Rd/cp) / thetav_env[i-1] * dz
-        p_env[i] = p_Rdcp[i]**(cp/Rd)
-        exner_env[i] = (p_env[i]/p0)**(Rd/cp)
-        thetav_env[i], ql = calc_thetav(theta_env[i], q_env[i], p_env[i], exner_env[i])
-        if ql > 0:
-            print(f"Warning, environmental profile is saturated at z = {z[i]} m")
 
-    rho_env = p_env / (Rd * exner_env * thetav_env)
+# The skew-T background is the same for all plots, it is computed once per process.
+skew_background = None
+
+
+def get_skew_background():
+    global skew_background
+
+    if skew_background is None:
+        skew_background = calc_skew_background()
+        for x, y in skew_background.values():
+            x.setflags(write=False)
+            y.setflags(write=False)
+
+    return skew_background
+
+
+# Environment column of a sounding for the skew-T plot, computed up to z_max (m).
+def calc_sounding_column(h, theta, dtheta, gammatheta, q, dq, gammaq, p0, dz=10, z_max=5_000):
+    # Create the grid.
+    z = np.arange(0, z_max + dz/2, dz)
+
+    # Compute the environmental profiles with the builder of the plume environment.
+    return EnvironmentColumn(z, h, theta, dtheta, gammatheta, q, dq, gammaq, n=len(z), ps=p0)
+
+
+# Pressure (hPa), temperature and dewpoint (degC) of a sounding column.
+def calc_sounding_lines(column):
+    theta_env = column.theta
+    q_env = column.q
+    p_env = column.p
+    exner_env = column.exner
 
     T_env = exner_env * theta_env - 273.15 # In Celcius
     w_env = q_env / (1.0 - q_env)
@@ -392,4 +1966,3 @@ def calc_skew_lines(h, theta, dtheta, gammatheta, q, dq, gammaq, p0):
     Td_env = (243.12 * np.log(e_env/611.2)) / (17.62 - np.log(e_env/611.2))
 
     return p_env / 100, T_env, Td_env
-